@@ -0,0 +1,417 @@
+"""ASGI entry point, for serving many open connections from one process.
+
+The Flask server holds a thread for every request in progress, so each
+player waiting on a long-polled status request costs a thread. This app
+handles the status and action endpoints with asyncio instead. A waiting
+request then costs only a suspended coroutine.
+
+- /join/<id>/status/, /play/<id>/status/<version>/, /play/<id>/action/ and
+  /watch/<id>/status/<version>/ are handled on the event loop.
+- Work that touches the game store runs in a thread pool, so disk writes
+  and game locks never block the loop.
+- Actions on each game are serialised by an asyncio lock, so at most one
+  pool thread works on a game at a time.
+- Waiting requests are woken by an asyncio event that is set when the game
+  is saved. Requests woken together that need the same response, such as
+  everyone watching a game, share one call to produce it.
+
+Every other route, such as /create/, joining a game and rendering pages, is
+passed to the Flask app in server.py in the thread pool. Sessions are
+signed the same way as Flask's, so both share the same cookies.
+
+Usage: uvicorn asgi:app
+"""
+import io
+import re
+import sys
+import time
+import asyncio
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import parse_cookie
+
+import server
+from store import GameStore, GameNotFoundException, GAME_ID_REGEX
+
+
+# Routes handled on the event loop, the name of the handler for each, and the
+# name of the equivalent Flask endpoint, which is used in metrics
+GAME_ID = "(" + GAME_ID_REGEX + ")"
+ROUTES = [
+    ("GET", re.compile(r"^/join/{}/status/$".format(GAME_ID)), "join_status",
+     "join_game_status"),
+    ("GET", re.compile(r"^/play/{}/status/(\d+)/$".format(GAME_ID)),
+     "game_status", "get_game_status"),
+    ("POST", re.compile(r"^/play/{}/action/$".format(GAME_ID)), "action",
+     "perform_action"),
+    ("GET", re.compile(r"^/watch/{}/status/(\d+)/$".format(GAME_ID)),
+     "spectator_status", "get_spectator_status")
+]
+
+
+class GameEvents(object):
+    """asyncio events that are set when a game is saved or evicted, locks to
+    serialise changes to each game, and calls in progress that coroutines can
+    share"""
+
+    def __init__(self, loop, shared=False):
+        self.loop = loop
+        self.shared = shared
+        self.events = {}
+        self.locks = {}
+        self.calls = {}
+
+    def notify(self, game_id, evicted=False):
+        """Wake up coroutines waiting for the specified game to change, and
+        forget the game if it was evicted. This may be called from any
+        thread"""
+        self.loop.call_soon_threadsafe(self.set_event, game_id, evicted)
+
+    def set_event(self, game_id, evicted=False):
+        event = self.events.pop(game_id, None)
+        if event is not None:
+            event.set()
+
+        # Requests still holding the lock keep their reference to it, and new
+        # requests for the game are refused since it no longer exists
+        if evicted:
+            self.locks.pop(game_id, None)
+
+    def lock(self, game_id):
+        """Return the asyncio lock for the specified game"""
+        if game_id not in self.locks:
+            self.locks[game_id] = asyncio.Lock()
+        return self.locks[game_id]
+
+    async def call_once(self, key, func, *args):
+        """Run func(*args) in the thread pool and return its result. If a call
+        with the same key is already running, wait for its result instead of
+        starting another"""
+        future = self.calls.get(key)
+        if future is None:
+            future = run_in_pool(func, *args)
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None))
+
+        # Shield the call so that it is not cancelled along with one of the
+        # coroutines waiting for it
+        return await asyncio.shield(future)
+
+    async def wait_for_change(self, game_id, check, timeout):
+        """Wait until the coroutine function check() returns a true value, the
+        game is evicted, or timeout seconds have passed, and return the last
+        value returned by check(). check() is only called again once the
+        game's revision has changed"""
+        end_time = self.loop.time() + timeout
+        checked_revision = None
+        result = None
+
+        while True:
+            # Get the event before checking, so that a save made while check()
+            # is running still wakes this coroutine
+            if game_id not in self.events:
+                self.events[game_id] = asyncio.Event()
+            event = self.events[game_id]
+
+            revision = server.game_store.get_revision(game_id)
+            if checked_revision is None or revision != checked_revision:
+                checked_revision = revision
+                try:
+                    result = await check()
+                except GameNotFoundException:
+                    return result
+                if result:
+                    return result
+
+            remaining = end_time - self.loop.time()
+            if remaining <= 0:
+                return result
+
+            # Other processes do not notify this one when they save a game,
+            # so wake up regularly to check for changes
+            if self.shared:
+                remaining = min(remaining, GameStore.SHARED_POLL_INTERVAL)
+
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+game_events = None
+
+
+def get_game_events():
+    """Return the GameEvents object for the running event loop, creating it
+    on first use"""
+    global game_events
+    if game_events is None:
+        game_events = GameEvents(asyncio.get_event_loop(),
+                                 shared=server.SHARED_STATE)
+        server.game_store.add_listener(game_events.notify)
+    return game_events
+
+
+def run_in_pool(func, *args):
+    """Run a function in the default thread pool and return an awaitable for
+    its result"""
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def get_session(headers):
+    """Return the contents of the Flask session cookie sent with a request, or
+    an empty dictionary if there is no valid session"""
+    cookies = parse_cookie(headers.get("cookie", ""))
+    value = cookies.get(server.app.config["SESSION_COOKIE_NAME"])
+    if not value:
+        return {}
+
+    serializer = server.app.session_interface.get_signing_serializer(
+        server.app
+    )
+    max_age = int(server.app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+def get_long_poll_wait(query):
+    """Return the number of seconds to hold a status request open for, as
+    given by the 'wait' query parameter"""
+    try:
+        wait = float(query.get("wait", ["0"])[0])
+    except ValueError:
+        wait = 0
+    return max(0, min(wait, server.LONG_POLL_TIMEOUT))
+
+
+class Request(object):
+    """The parts of an HTTP request needed by the handlers in this module"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qs(scope["query_string"].decode("latin-1"))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1")
+                        for k, v in scope["headers"]}
+        self.body = body
+
+    def get_username(self, game_id):
+        """Return the user's name in the specified game, aborting with a 403
+        if they have not joined it"""
+        session = get_session(self.headers)
+        if game_id not in session:
+            abort(403)
+        return session[game_id]
+
+
+async def join_status(request, game_id):
+    """Return the matchmaking status of a game (see
+    server.join_game_status())"""
+    try:
+        players = int(request.query["players"][0])
+    except (KeyError, ValueError):
+        players = None
+    wait = get_long_poll_wait(request.query)
+
+    if players is not None and wait:
+        def changed():
+            return len(server.game_store.get(game_id).player_names) != players
+
+        await get_game_events().wait_for_change(
+            game_id, lambda: run_in_pool(changed), wait
+        )
+
+    cached = await run_in_pool(server.load_join_status, game_id)
+    return cached.encode(request.headers.get("accept-encoding"),
+                         request.headers.get("if-none-match"))
+
+
+async def game_status(request, game_id, version):
+    """Return the status of a game (see server.get_game_status())"""
+    return await status_response(request, game_id, int(version),
+                                 request.get_username(game_id))
+
+
+async def spectator_status(request, game_id, version):
+    """Return the status of a game as seen by spectators (see
+    server.get_spectator_status())"""
+    return await status_response(request, game_id, int(version),
+                                 server.SPECTATOR)
+
+
+async def status_response(request, game_id, version, username):
+    """Return the status of a game as seen by the user given"""
+    wait = get_long_poll_wait(request.query)
+    response = {}
+
+    async def load():
+        # Requests woken by the same change share one call to load the
+        # response, and later ones find it in the cache without using the
+        # thread pool
+        cached = server.get_cached_game_status(game_id, username, version)
+        if cached is None:
+            revision = server.game_store.get_revision(game_id)
+            cached = await get_game_events().call_once(
+                ("status", game_id, revision, username, version),
+                load_game_status, game_id, username, version
+            )
+        response["cached"] = cached
+        return cached.body is not None
+
+    if wait:
+        await get_game_events().wait_for_change(game_id, load, wait)
+    if "cached" not in response:
+        await load()
+
+    return response["cached"].encode(request.headers.get("accept-encoding"),
+                                     request.headers.get("if-none-match"))
+
+
+def load_game_status(game_id, username, version):
+    server.check_game_ready(game_id)
+    return server.load_game_status(game_id, username, version)
+
+
+async def action(request, game_id):
+    """Perform an action in a game (see server.perform_action())"""
+    username = request.get_username(game_id)
+    form = parse_qs(request.body.decode())
+
+    try:
+        action_id = int(form["action_id"][0])
+    except (KeyError, ValueError):
+        return text_response("Must provide integer value 'action_id'", 400)
+
+    try:
+        version = int(form["version"][0])
+    except (KeyError, ValueError):
+        version = None
+
+    async with get_game_events().lock(game_id):
+        message, status = await run_in_pool(server.perform_action_as, game_id,
+                                            username, action_id, version)
+    return text_response(message, status)
+
+
+def text_response(message, status=200):
+    """Return a (status code, headers, body) tuple for a plain text
+    response"""
+    return (status, [("Content-Type", "text/html; charset=utf-8")],
+            message.encode())
+
+
+async def handle(request, handler_name, args):
+    """Call the named handler and return its (status code, headers, body)
+    tuple, turning errors into error responses"""
+    game_id = args[0]
+    try:
+        if not server.game_store.exists(game_id):
+            abort(404)
+        return await globals()[handler_name](request, *args)
+
+    except HTTPException as e:
+        return text_response(e.name, e.code)
+    except GameNotFoundException as e:
+        return text_response(str(e), 404)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+def call_wsgi(scope, body):
+    """Pass a request to the Flask app and return its (status code, headers,
+    body) tuple"""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+        else:
+            key = "HTTP_" + name
+            environ[key] = (environ[key] + "," + value if key in environ
+                            else value)
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = server.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+    return response["status"], response["headers"], body
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                get_game_events()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+
+    for method, pattern, handler_name, endpoint in ROUTES:
+        match = pattern.match(scope["path"])
+        if match and scope["method"] == method:
+            start = time.perf_counter()
+            request = Request(scope, body)
+            status, headers, body = await handle(request, handler_name,
+                                                 match.groups())
+            server.record_request(endpoint, status,
+                                  time.perf_counter() - start)
+            break
+    else:
+        status, headers, body = await run_in_pool(call_wsgi, scope, body)
+
+    if not any(k.lower() == "content-length" for k, v in headers):
+        headers = headers + [("Content-Length", str(len(body)))]
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1"))
+                    for k, v in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,161 @@
+"""Load test for how many long-polled status requests a server can hold.
+
+The test creates a game on a running server and joins it as two players. It
+then opens the given number of concurrent status requests that wait for the
+game to change. Once they are all open, it performs an action and measures
+how long each request takes to return the new status. With --spectate the
+requests are made by spectators rather than by the waiting player.
+
+Start the server under test first, e.g. for the asyncio server:
+
+    ulimit -n 65536
+    uvicorn asgi:app --port 5000
+
+Usage: python bench_connections.py --help
+"""
+import time
+import json
+import asyncio
+import argparse
+import resource
+from urllib.parse import urlencode, urlsplit
+
+
+async def http_request(host, port, method, path, cookie=None, form=None):
+    """Send an HTTP/1.1 request and return the status code, a dictionary of
+    response headers and the body"""
+    body = urlencode(form).encode() if form else b""
+    lines = ["{} {} HTTP/1.1".format(method, path),
+             "Host: {}:{}".format(host, port),
+             "Connection: close",
+             "Content-Length: {}".format(len(body))]
+    if form:
+        lines.append("Content-Type: application/x-www-form-urlencoded")
+    if cookie:
+        lines.append("Cookie: " + cookie)
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    head_lines = head.decode("latin-1").split("\r\n")
+    status = int(head_lines[0].split()[1])
+    headers = {}
+    for line in head_lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers, body
+
+
+async def join(host, port, path, username):
+    """Join a game and return the session cookie"""
+    status, headers, body = await http_request(host, port, "POST", path,
+                                               form={"username": username})
+    if status != 200:
+        raise Exception("Could not join game: {}".format(body))
+    return headers["set-cookie"].split(";")[0]
+
+
+async def run(url, connections, wait, spectate=False):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+
+    status, headers, body = await http_request(host, port, "POST", "/create/",
+                                               form={"no_of_players": 2})
+    join_path = urlsplit(headers["location"]).path
+    play_path = join_path.replace("/join/", "/play/")
+    cookies = {name: await join(host, port, join_path, name)
+               for name in ["Ann", "Bob"]}
+
+    status, headers, body = await http_request(
+        host, port, "GET", play_path + "status/0/", cookie=cookies["Ann"]
+    )
+    game_status = json.loads(body.decode())
+    version = game_status["version"]
+    current = game_status["current_player"]
+    waiting = "Bob" if current == "Ann" else "Ann"
+
+    # Open the long-polled requests
+    if spectate:
+        status_path = play_path.replace("/play/", "/watch/") + "status/"
+        cookie = None
+    else:
+        status_path = play_path + "status/"
+        cookie = cookies[waiting]
+    path = "{}{}/?wait={}".format(status_path, version, wait)
+    returned = {"early": 0}
+    times = []
+    errors = []
+
+    async def poll():
+        try:
+            status, _, _ = await http_request(host, port, "GET", path,
+                                              cookie=cookie)
+        except OSError as e:
+            errors.append(str(e))
+            return
+        if action_time is None:
+            returned["early"] += 1
+        elif status == 200:
+            times.append(time.perf_counter() - action_time)
+        else:
+            errors.append("HTTP {}".format(status))
+
+    action_time = None
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(poll()) for i in range(connections)]
+
+    # Give the server time to accept every connection before changing the
+    # game
+    await asyncio.sleep(min(wait / 2, 2 + connections / 2000))
+    open_time = time.perf_counter() - start
+
+    action_time = time.perf_counter()
+    status, _, body = await http_request(
+        host, port, "POST", play_path + "action/", cookie=cookies[current],
+        form={"action_id": 0, "version": version}
+    )
+    if status != 200:
+        raise Exception("Action failed: {}".format(body))
+
+    await asyncio.gather(*tasks)
+    total_time = time.perf_counter() - action_time
+
+    times.sort()
+    print("{} connections opened in {:.2f}s".format(connections, open_time))
+    print("  {} returned before the game changed, {} errors".format(
+        returned["early"], len(errors)))
+    if errors:
+        print("  first error: {}".format(errors[0]))
+    if times:
+        print("  {} woken by the action in {:.2f}s".format(len(times),
+                                                           total_time))
+        print("  latency p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            times[len(times) // 2] * 1000,
+            times[int(len(times) * 0.99)] * 1000,
+            times[-1] * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000",
+                        help="base URL of the server under test")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--wait", type=float, default=25,
+                        help="long poll wait time to request, in seconds")
+    parser.add_argument("--spectate", action="store_true",
+                        help="wait for the game to change as spectators")
+    args = parser.parse_args()
+
+    # Each connection needs a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.url, args.connections, args.wait,
+                                args.spectate))
@@ -0,0 +1,109 @@
+"""Micro-benchmark comparing the old linear scan over every map link in
+Game.get_links with the adjacency index lookup, across every city on the
+Europe map.
+
+Usage: python bench_links.py [repeats]
+"""
+import sys
+import timeit
+
+from gamemap import Edge, LinkTypes, get_map
+from jte import Game, Turn
+
+
+def scan_links(game):
+    """The original implementation of Game.get_links, which checks every link
+    in the map"""
+    player = game.current_player
+    available_links = []
+
+    for link in game.game_map.links:
+        if player.current_city in link.cities:
+
+            if (game.current_turn.dice_points is None and
+                    link.type != LinkTypes.SEA):
+                continue
+
+            if (game.current_turn.dice_points is not None and
+                    link.type == LinkTypes.SEA):
+                continue
+
+            if (link.type == LinkTypes.AIR and
+                    game.current_turn.flown):
+                continue
+
+            if (link.cost is not None and
+                    link.cost > game.current_turn.dice_points):
+                continue
+
+            if link.cities[0] == player.current_city:
+                to_city = link.cities[1]
+            else:
+                to_city = link.cities[0]
+
+            if to_city in game.current_turn.cities:
+                continue
+
+            available_links.append(Edge(to_city, link.type, link.cost))
+
+    return available_links
+
+
+def turn_states(city_id):
+    """Return a list of turns starting at the given city covering each branch
+    in get_links: before rolling, after rolling, and after flying"""
+    states = []
+    for dice_points, flown in [(None, False), (4, False), (6, True)]:
+        turn = Turn(city_id)
+        turn.dice_points = dice_points
+        turn.dice_roll = dice_points
+        turn.flown = flown
+        states.append(turn)
+    return states
+
+
+def run_all(game, get_links):
+    """Call get_links for every city and turn state on the map"""
+    for city_id in range(len(game.game_map.cities)):
+        game.current_player.current_city = city_id
+        for turn in turn_states(city_id):
+            game.current_turn = turn
+            get_links()
+
+
+def edge_key(edge):
+    return (edge.to_city, edge.type.value)
+
+
+def check_equal(game):
+    """Check the two implementations return the same links for every city"""
+    for city_id in range(len(game.game_map.cities)):
+        game.current_player.current_city = city_id
+        for turn in turn_states(city_id):
+            game.current_turn = turn
+            old = sorted(scan_links(game), key=edge_key)
+            new = sorted(game.get_links(), key=edge_key)
+            if old != new:
+                raise AssertionError("Mismatch at city {}".format(city_id))
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    game_map = get_map("europe")
+    game = Game(game_map, ["John", "Yoko"])
+    check_equal(game)
+
+    calls = len(game_map.cities) * len(turn_states(0))
+    results = [
+        ("linear scan", lambda: run_all(game, lambda: scan_links(game))),
+        ("adjacency index", lambda: run_all(game, game.get_links))
+    ]
+
+    print("{} cities, {} links, {} calls per run".format(
+        len(game_map.cities), len(game_map.links), calls))
+
+    for name, func in results:
+        best = min(timeit.repeat(func, number=1, repeat=repeats))
+        print("{:<16} {:8.3f} ms/run {:8.2f} us/call".format(
+            name, best * 1000, best * 1e6 / calls))
@@ -0,0 +1,362 @@
+"""End to end load test that plays complete tables against a running server.
+
+For each concurrency level the test creates that many games through
+/create/ and joins each with the given number of players. Every player runs
+in its own thread, like a browser would:
+- it long-polls /play/<id>/status/<version>/ for changes;
+- when it is the player's turn, it waits for the think time and then posts a
+  random action to /play/<id>/action/.
+
+After running each level for a fixed time the test records the moves made
+per second, the latency percentiles for each endpoint and the error rate.
+Status latencies include the time requests are held open waiting for the
+game to change, so they measure how quickly players see moves rather than
+the cost of a request.
+The saturation point is the first level where adding games stopped adding
+throughput in proportion.
+
+The server can be started by the test (--start-server) or started
+separately (--url). Results are printed and can be written as JSON with
+--output, so that storage and serving modes can be compared.
+
+Usage: python bench_server.py --help
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode, urlsplit
+
+
+# Commands to start each kind of server on a given port
+SERVER_COMMANDS = {
+    "flask": [sys.executable, "-c",
+              "import server; server.app.run(port={port}, threaded=True)"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi:app", "--port", "{port}",
+             "--log-level", "warning"]
+}
+
+# Long poll wait time requested by players, in seconds
+POLL_WAIT = 10
+
+# A level is saturated if its throughput grew by less than this fraction of
+# the growth in the number of games
+SATURATION_EFFICIENCY = 0.5
+
+
+class Client(object):
+    """An HTTP client with a persistent connection and a session cookie"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection = None
+        self.cookie = None
+
+    def request(self, method, path, form=None, timeout=POLL_WAIT + 10):
+        """Send a request and return the status code, headers and body"""
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port,
+                                                         timeout=timeout)
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";")[0]
+        return response.status, response, data
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class Recorder(object):
+    """Latencies and outcomes of requests made during a level, by
+    endpoint"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+        self.moves = 0
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency, status):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            counts = self.statuses.setdefault(endpoint, {})
+            counts[status] = counts.get(status, 0) + 1
+            if status == 200 and endpoint == "action":
+                self.moves += 1
+
+    def record_error(self, endpoint, error):
+        with self.lock:
+            name = type(error).__name__
+            errors = self.errors.setdefault(endpoint, {})
+            errors[name] = errors.get(name, 0) + 1
+
+    def timed(self, client, endpoint, method, path, form=None):
+        """Make a request with the client, recording its latency and status,
+        and return the status and body. Return (None, None) on errors"""
+        start = time.perf_counter()
+        try:
+            status, _, body = client.request(method, path, form)
+        except (OSError, http.client.HTTPException) as e:
+            self.record_error(endpoint, e)
+            return None, None
+        self.record(endpoint, time.perf_counter() - start, status)
+        return status, body
+
+
+def percentile_ms(values, fraction):
+    """Return a percentile of a list of times in seconds, in milliseconds, or
+    None if the list is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+
+def create_table(host, port, no_of_players):
+    """Create a game and join it as the given number of players. Return the
+    game's play path and a list of Clients, one per player"""
+    creator = Client(host, port)
+    status, response, _ = creator.request(
+        "POST", "/create/", {"no_of_players": no_of_players}
+    )
+    if status != 302:
+        raise Exception("Could not create game: HTTP {}".format(status))
+    join_path = urlsplit(response.getheader("Location")).path
+    creator.close()
+
+    clients = []
+    for i in range(no_of_players):
+        client = Client(host, port)
+        status, _, body = client.request("POST", join_path,
+                                         {"username": "Player{}".format(i)})
+        if status != 200:
+            raise Exception("Could not join game: {}".format(body))
+        clients.append(client)
+
+    return join_path.replace("/join/", "/play/"), clients
+
+
+def play(client, play_path, recorder, think_time, stop_event, rng):
+    """Play as one player until stop_event is set or the game ends"""
+    version = 0
+    while not stop_event.is_set():
+        path = "{}status/{}/?wait={}".format(play_path, version, POLL_WAIT)
+        status, body = recorder.timed(client, "status", "GET", path)
+        if status is None:
+            time.sleep(0.1)
+            continue
+        if status != 200:
+            continue
+
+        game_status = json.loads(body.decode())
+        version = game_status["version"]
+        if not game_status.get("in_progress", True):
+            return
+
+        actions = game_status.get("actions")
+        if not actions:
+            continue
+
+        stop_event.wait(think_time * rng.uniform(0.5, 1.5))
+        form = {"action_id": rng.choice(actions)["id"], "version": version}
+        recorder.timed(client, "action", "POST", play_path + "action/", form)
+
+
+def run_level(host, port, games, players, duration, think_time, seed):
+    """Play the given number of games at once for duration seconds and return
+    a dictionary of results"""
+    recorder = Recorder()
+    stop_event = threading.Event()
+
+    tables = [create_table(host, port, players) for i in range(games)]
+    threads = []
+    for i, (play_path, clients) in enumerate(tables):
+        for j, client in enumerate(clients):
+            rng = random.Random("{}-{}-{}".format(seed, i, j))
+            thread = threading.Thread(target=play, daemon=True, args=(
+                client, play_path, recorder, think_time, stop_event, rng
+            ))
+            threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop_event.wait(duration)
+    stop_event.set()
+    elapsed = time.perf_counter() - start
+
+    # Players may be waiting on a long poll; let them finish in the
+    # background rather than waiting for the poll to time out
+    for thread in threads:
+        thread.join(0.1)
+
+    result = {
+        "games": games,
+        "players": games * players,
+        "duration": elapsed,
+        "moves": recorder.moves,
+        "moves_per_second": recorder.moves / elapsed,
+        "endpoints": {}
+    }
+
+    with recorder.lock:
+        for endpoint in sorted(set(recorder.statuses) | set(recorder.errors)):
+            latencies = recorder.latencies.get(endpoint, [])
+            statuses = recorder.statuses.get(endpoint, {})
+            errors = recorder.errors.get(endpoint, {})
+            requests = len(latencies) + sum(errors.values())
+            failed = sum(errors.values()) + sum(
+                n for s, n in statuses.items() if s >= 500
+            )
+            result["endpoints"][endpoint] = {
+                "requests": requests,
+                "requests_per_second": requests / elapsed,
+                "statuses": {str(s): n for s, n in sorted(statuses.items())},
+                "errors": errors,
+                "error_rate": failed / requests if requests else 0,
+                "p50_ms": percentile_ms(latencies, 0.5),
+                "p99_ms": percentile_ms(latencies, 0.99)
+            }
+
+    for _, clients in tables:
+        for client in clients:
+            client.close()
+    return result
+
+
+def find_saturation(levels):
+    """Return the number of games at the first level whose throughput grew by
+    less than SATURATION_EFFICIENCY of the growth in games, or None"""
+    for previous, level in zip(levels, levels[1:]):
+        if previous["moves_per_second"] == 0:
+            continue
+        games_growth = level["games"] / previous["games"] - 1
+        throughput_growth = (level["moves_per_second"] /
+                             previous["moves_per_second"] - 1)
+        if throughput_growth < games_growth * SATURATION_EFFICIENCY:
+            return level["games"]
+    return None
+
+
+def start_server(mode, port, env_vars):
+    """Start a server process in a temporary games directory and return the
+    process and the directory"""
+    games_dir = tempfile.mkdtemp(prefix="jte-bench-")
+    env = dict(os.environ, JTE_GAMES_DIR=games_dir, **env_vars)
+    command = [arg.format(port=port) for arg in SERVER_COMMANDS[mode]]
+    process = subprocess.Popen(command, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # Wait for the server to accept connections
+    for i in range(100):
+        try:
+            Client("127.0.0.1", port).request("GET", "/create/", timeout=1)
+            return process, games_dir
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise Exception("Server did not start")
+
+
+def print_level(level):
+    print("{} games: {:.1f} moves/s".format(level["games"],
+                                           level["moves_per_second"]))
+    for endpoint, stats in level["endpoints"].items():
+        print("  {:<7} {:7.1f} req/s  p50 {}  p99 {}  errors {:.2%}".format(
+            endpoint, stats["requests_per_second"],
+            format_ms(stats["p50_ms"]), format_ms(stats["p99_ms"]),
+            stats["error_rate"]))
+
+
+def format_ms(value):
+    return "-" if value is None else "{:.1f}ms".format(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000",
+                        help="base URL of the server under test")
+    parser.add_argument("--start-server", choices=sorted(SERVER_COMMANDS),
+                        help="start a server of this kind on the port in "
+                             "--url, with a temporary games directory")
+    parser.add_argument("--shared-state", action="store_true",
+                        help="set JTE_SHARED_STATE on the started server")
+    parser.add_argument("--games", default="1,2,4,8,16",
+                        help="comma separated numbers of concurrent games to "
+                             "run in turn")
+    parser.add_argument("--players", type=int, default=3,
+                        help="number of players in each game")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="number of seconds to run each level for")
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="average number of seconds a player takes to "
+                             "choose a move")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write JSON results to")
+    args = parser.parse_args()
+
+    parts = urlsplit(args.url)
+    host, port = parts.hostname, parts.port or 80
+
+    process = None
+    if args.start_server:
+        env_vars = {"JTE_SHARED_STATE": "1"} if args.shared_state else {}
+        process, games_dir = start_server(args.start_server, port, env_vars)
+
+    try:
+        levels = []
+        for games in [int(g) for g in args.games.split(",")]:
+            level = run_level(host, port, games, args.players, args.duration,
+                              args.think_time, args.seed)
+            print_level(level)
+            levels.append(level)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(games_dir, ignore_errors=True)
+
+    saturation = find_saturation(levels)
+    print("Throughput saturated at {}".format(
+        "{} games".format(saturation) if saturation else "no level tested"))
+
+    results = {
+        "url": args.url,
+        "server": args.start_server,
+        "shared_state": args.shared_state,
+        "players": args.players,
+        "think_time": args.think_time,
+        "duration": args.duration,
+        "saturation_games": saturation,
+        "levels": levels
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
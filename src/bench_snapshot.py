@@ -0,0 +1,69 @@
+"""Benchmark comparing saving and restoring games with pickle against the
+snapshot format in snapshot.py.
+
+Usage: python bench_snapshot.py [number of games]
+"""
+import sys
+import pickle
+import random
+import timeit
+
+import snapshot
+from gamemap import get_map
+from matchmaking import Matchmaker
+
+
+def random_matchmakers(count, moves=50):
+    """Return a list of Matchmaker objects for 3 player games on the Europe map
+    each advanced by making random moves"""
+    matchmakers = []
+    for i in range(count):
+        m = Matchmaker(3, get_map("europe"))
+        for name in ["John", "Paul", "Yoko"]:
+            m.add_player(name)
+
+        for j in range(moves):
+            if not m.game.in_progress:
+                break
+            action = random.choice(m.game.available_actions)
+            m.game.perform_action(action.id, m.game.current_player.name)
+
+        matchmakers.append(m)
+    return matchmakers
+
+
+def check_round_trip(matchmakers):
+    """Check that restoring a snapshot gives the same game status"""
+    for m in matchmakers:
+        restored = snapshot.load_matchmaker(snapshot.dump_matchmaker(m))
+        for name in m.player_names:
+            if restored.game.get_status(name) != m.game.get_status(name):
+                raise AssertionError("Snapshot did not restore game")
+
+
+def time_per_game(func, matchmakers):
+    best = min(timeit.repeat(lambda: [func(m) for m in matchmakers],
+                             number=1, repeat=5))
+    return best * 1e6 / len(matchmakers)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    random.seed(0)
+    matchmakers = random_matchmakers(count)
+    check_round_trip(matchmakers)
+
+    formats = [
+        ("pickle", pickle.dumps, pickle.loads),
+        ("snapshot", snapshot.dump_matchmaker, snapshot.load_matchmaker)
+    ]
+
+    print("{} games".format(count))
+    for name, dump, load in formats:
+        encoded = [dump(m) for m in matchmakers]
+        size = sum(len(e) for e in encoded) / count
+        dump_time = time_per_game(dump, matchmakers)
+        load_time = time_per_game(load, encoded)
+        print("{:<9} {:7.0f} bytes {:8.1f} us/dump {:8.1f} us/load".format(
+            name, size, dump_time, load_time))
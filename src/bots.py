@@ -0,0 +1,73 @@
+"""Move selection for computer-controlled players.
+
+Each available action is scored by the estimated number of dice points the
+player would still need to reach their nearest remaining city after taking
+it, using the distances in the map's RouteTable, and the lowest scoring action
+is chosen. This only reads the game state, so choosing an action costs a few
+table lookups per available action and never copies the game.
+"""
+from gamemap import LinkTypes
+from routes import SEA_COST, get_route_table
+
+
+# The expected number of dice points from a roll
+EXPECTED_ROLL = 3.5
+
+
+def get_targets(player):
+    """Return the list of cities the player should head towards: the cities
+    they have not yet visited, excluding their home city unless it is the
+    only one left"""
+    targets = player.get_remaining_cities()
+    if len(targets) > 1 and player.home_city in targets:
+        targets.remove(player.home_city)
+    return targets
+
+
+def choose_action(game):
+    """Return the ID of the action the current player of the game should
+    perform"""
+    table = get_route_table(game.game_map)
+    player = game.current_player
+    targets = get_targets(player)
+
+    def distance_to_target(city):
+        distances = [table.get_distance(city, t) for t in targets]
+        distances = [d for d in distances if d is not None]
+        return min(distances) if distances else float("inf")
+
+    best_action = None
+    best_score = None
+
+    for action in game.available_actions:
+        if action.type == game.ROLL_DICE_ACTION:
+            score = distance_to_target(player.current_city)
+
+            # Rolling on an island only wastes the turn
+            city = player.current_city
+            if (game.game_map.links_from(city, LinkTypes.LAND) or
+                    game.game_map.links_from(city, LinkTypes.AIR)):
+                score -= EXPECTED_ROLL
+            else:
+                score += SEA_COST
+
+        elif action.type == game.TRAVEL_ACTION:
+            link = action.link
+            if link.to_city in targets:
+                # Reaching a target ends the turn, so there is nothing better
+                return action.id
+
+            score = distance_to_target(link.to_city)
+
+        elif action.type == game.WAIT_AT_PORT_ACTION:
+            # Waiting uses up this turn and sailing uses up the next one
+            sea_links = game.game_map.links_from(player.current_city,
+                                                 LinkTypes.SEA)
+            score = min(distance_to_target(l.to_city) for l in sea_links)
+            score += SEA_COST
+
+        if best_score is None or score < best_score:
+            best_action = action
+            best_score = score
+
+    return best_action.id
@@ -0,0 +1,83 @@
+"""Map compiler: validates map files and writes a compiled file for each.
+
+A compiled map is stored next to its map file, with gamemap.COMPILED_SUFFIX
+added to the name. It contains the map after loading, so starting a process
+does not need to parse the JSON or build anything again:
+- the cities, links and airports;
+- the adjacency index and the set of sea ports;
+- the cities in each deck;
+- the distance tables from routes.RouteTable.
+
+It is a pickle that is read in one go. It also stores a hash of the map file
+it was compiled from, and get_map() ignores it if the map file has changed
+since. Maps that are not compiled are validated and built when they are
+first loaded.
+
+Usage: python compile_maps.py --help
+"""
+import os
+import sys
+import json
+import pickle
+import argparse
+
+import gamemap
+from fileutil import write_atomic
+from gamemap import GameMap, InvalidMapException, UnknownMapException
+from routes import RouteTable
+
+
+def compile_map(map_id):
+    """Validate a map file and write its compiled file. Raise
+    InvalidMapException if the map is invalid"""
+    filename = gamemap.get_map_filename(map_id)
+    with open(filename, "rb") as map_file:
+        source = map_file.read()
+
+    game_map = GameMap(map_id, json.loads(source.decode()))
+    route_table = RouteTable(game_map)
+    game_map.route_tables = (route_table.distances, route_table.next_city)
+
+    compiled = {
+        "version": gamemap.COMPILED_VERSION,
+        "source_hash": gamemap.get_source_hash(source),
+        "map": game_map.to_compiled()
+    }
+    # Processes starting while the map is compiled must never read a partly
+    # written file
+    compiled_filename = filename + gamemap.COMPILED_SUFFIX
+    write_atomic(compiled_filename,
+                 pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL))
+    os.chmod(compiled_filename, 0o644)
+
+    return game_map
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("maps", nargs="*", metavar="MAP",
+                        help="ID of a map to compile (default: all maps)")
+    parser.add_argument("--check", action="store_true",
+                        help="only validate the maps, without writing "
+                             "compiled files")
+    args = parser.parse_args()
+
+    failed = False
+    for map_id in args.maps or sorted(gamemap.MAPS):
+        try:
+            if args.check:
+                filename = gamemap.get_map_filename(map_id)
+                with open(filename) as map_file:
+                    game_map = GameMap(map_id, json.load(map_file))
+            else:
+                game_map = compile_map(map_id)
+        except (InvalidMapException, UnknownMapException) as e:
+            print(e)
+            failed = True
+            continue
+
+        print("{}: {} cities, {} links, up to {} players".format(
+            map_id, len(game_map.cities), len(game_map.links),
+            game_map.max_players))
+
+    sys.exit(1 if failed else 0)
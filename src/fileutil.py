@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+
+# Prefix for the temporary files written by write_atomic()
+TEMP_FILE_PREFIX = ".tmp-"
+
+
+def write_atomic(filename, data):
+    """Write the bytes provided to a file via a temporary file in the same
+    directory, so that readers see either the old or the new contents of the
+    file and never a partially written one"""
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                        prefix=TEMP_FILE_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
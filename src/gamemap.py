@@ -0,0 +1,355 @@
+import os
+import json
+import pickle
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict
+from enum import Enum
+
+
+MAP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+MapInfo = namedtuple("MapInfo", ["title", "filename", "image"])
+
+# The maps games can be played on, by map ID. filename is the JSON file the map
+# is loaded from and image the picture of the map in the static directory
+MAPS = OrderedDict([
+    ("europe", MapInfo("Europe", "europe-map.json", "europe.png")),
+    ("southampton", MapInfo("Southampton", "map.json", "map.png"))
+])
+
+# The largest number of maps to keep loaded at once (see MapRegistry)
+MAX_LOADED_MAPS = 8
+
+# Compiled maps (see compile_maps.py) are stored next to the map file with
+# this suffix added. COMPILED_VERSION is changed whenever their contents change
+COMPILED_SUFFIX = ".compiled"
+COMPILED_VERSION = 1
+
+# Each player is dealt this many cards from each deck
+CARDS_PER_DECK = 3
+
+
+class UnknownMapException(Exception):
+    """There is no map with the specified ID"""
+
+
+class InvalidMapException(Exception):
+    """A map file does not describe a map that games can be played on"""
+
+
+class LinkTypes(Enum):
+    """An enum to store the availble types of link between cities"""
+    LAND = "land"
+    SEA = "sea"
+    AIR = "air"
+
+
+City = namedtuple("City", ["name", "coords"])
+
+Link = namedtuple("Link", ["cities", "type", "cost"])
+
+
+class Edge(namedtuple("Edge", ["to_city", "type", "cost"])):
+    """A link as seen from one of the cities it connects. cost is None for
+    land and sea links"""
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """Return a JSON-serialisable dictionary of the form:
+            {"to_city": <destination city ID>,
+             "type": <link type>,
+             "cost": <link cost if type is "air">}
+        """
+        d = {"to_city": self.to_city, "type": self.type.value}
+        if self.cost is not None:
+            d["cost"] = self.cost
+        return d
+
+
+class GameMap(object):
+    """An immutable object to represent a map that games are played on. Each
+    map is loaded once per process (see get_map()) and shared by all games
+    that use it. When pickled only the map ID is stored"""
+
+    def __init__(self, map_id, map_dict):
+        problems = validate_map(map_dict)
+        if problems:
+            raise InvalidMapException("Map '{}' is invalid: {}".format(
+                map_id, "; ".join(problems)))
+
+        self.map_id = map_id
+
+        self.cities = tuple(City(c["name"], tuple(c["coords"]))
+                            for c in map_dict["cities"])
+        self.airports = tuple(map_dict.get("airports", []))
+        self.links = tuple(Link(tuple(l["cities"]), LinkTypes(l["type"]),
+                                l.get("cost"))
+                           for l in map_dict["links"])
+
+        # Adjacency index: for each city ID a dictionary mapping each link type
+        # to a tuple of the edges of that type leaving the city
+        adjacency = [{t: [] for t in LinkTypes} for c in self.cities]
+        for link in self.links:
+            a, b = link.cities
+            adjacency[a][link.type].append(Edge(b, link.type, link.cost))
+            adjacency[b][link.type].append(Edge(a, link.type, link.cost))
+
+        self.adjacency = tuple({t: tuple(edges) for t, edges in d.items()}
+                               for d in adjacency)
+
+        self.sea_ports = frozenset(c for link in self.links
+                                   if link.type == LinkTypes.SEA
+                                   for c in link.cities)
+
+        # Cities are split into 3 decks of consecutive city IDs
+        n = len(self.cities) // 3
+        self.decks = tuple(tuple(range(i * n, (i + 1) * n)) for i in range(3))
+
+        # Distance tables calculated by the map compiler, if the map was loaded
+        # from a compiled file (see routes.RouteTable)
+        self.route_tables = None
+
+        self.set_client_json()
+        self.derived = {}
+
+    def set_client_json(self):
+        """Store the parts of the map clients need as JSON, and a hash of it
+        that changes whenever the map does"""
+        self.client_json = json.dumps(
+            {"cities": self.get_city_dicts(), "airports": list(self.airports)},
+            separators=(",", ":"), sort_keys=True
+        ).encode()
+        self.content_hash = hashlib.sha256(self.client_json).hexdigest()[:16]
+
+    @property
+    def max_players(self):
+        """The largest number of players a game on this map can have"""
+        return len(self.decks[0]) // CARDS_PER_DECK
+
+    def to_compiled(self):
+        """Return a dictionary of the map's contents for the map compiler to
+        store"""
+        return {
+            "cities": self.cities,
+            "airports": self.airports,
+            "links": self.links,
+            "adjacency": self.adjacency,
+            "sea_ports": self.sea_ports,
+            "decks": self.decks,
+            "route_tables": self.route_tables
+        }
+
+    @classmethod
+    def from_compiled(cls, map_id, compiled):
+        """Return a GameMap from a dictionary returned by to_compiled(),
+        without validating it again"""
+        game_map = cls.__new__(cls)
+        game_map.map_id = map_id
+        for name, value in compiled.items():
+            setattr(game_map, name, value)
+        game_map.set_client_json()
+        game_map.derived = {}
+        return game_map
+
+    @property
+    def info(self):
+        """The MapInfo for this map"""
+        return MAPS[self.map_id]
+
+    def get_derived(self, name, build):
+        """Return the structure derived from the map stored under name,
+        calling build(map) to create it on first use. Derived structures are
+        kept for as long as the map is"""
+        if name not in self.derived:
+            self.derived.setdefault(name, build(self))
+        return self.derived[name]
+
+    def __reduce__(self):
+        # Pickle maps by reference so that saved games do not each carry a
+        # copy of the map
+        return (get_map, (self.map_id,))
+
+    def links_from(self, city_id, link_type):
+        """Return a tuple of the edges of the given type that leave the
+        specified city"""
+        return self.adjacency[city_id][link_type]
+
+    def get_city_name(self, city_id):
+        return self.cities[city_id].name
+
+    def get_city_dicts(self):
+        """Return a JSON-serialisable list of cities as they appear in the map
+        file"""
+        return [{"name": c.name, "coords": list(c.coords)} for c in self.cities]
+
+
+def validate_map(map_dict):
+    """Return a list of the problems with a map loaded from a map file, which
+    is empty if the map is valid"""
+    problems = []
+    cities = map_dict.get("cities", [])
+    n = len(cities)
+
+    # Cities are split evenly between 3 decks and every player is dealt
+    # CARDS_PER_DECK from each
+    if n % 3 != 0:
+        problems.append("number of cities ({}) is not a multiple of 3"
+                        .format(n))
+    if n < 3 * CARDS_PER_DECK:
+        problems.append("there must be at least {} cities".format(
+            3 * CARDS_PER_DECK))
+
+    names = set()
+    for i, city in enumerate(cities):
+        if not city.get("name") or len(city.get("coords", [])) != 2:
+            problems.append("city {} must have a name and 2 coords".format(i))
+        elif city["name"] in names:
+            problems.append("city name '{}' is used twice".format(city["name"]))
+        names.add(city.get("name"))
+
+    airports = map_dict.get("airports", [])
+    for city_id in airports:
+        if not isinstance(city_id, int) or not 0 <= city_id < n:
+            problems.append("airport {} is not a city ID".format(city_id))
+    if len(set(airports)) != len(airports):
+        problems.append("an airport is listed twice")
+
+    link_types = set(t.value for t in LinkTypes)
+    seen = set()
+    neighbours = [set() for c in cities]
+    for i, link in enumerate(map_dict.get("links", [])):
+        ends = link.get("cities", [])
+        if (len(ends) != 2 or
+                not all(isinstance(c, int) and 0 <= c < n for c in ends)):
+            problems.append("link {} does not join 2 city IDs".format(i))
+            continue
+        a, b = ends
+        if a == b:
+            problems.append("link {} joins city {} to itself".format(i, a))
+
+        if link.get("type") not in link_types:
+            problems.append("link {} has unknown type '{}'".format(
+                i, link.get("type")))
+        elif (link["type"] == LinkTypes.AIR.value and
+                not (isinstance(link.get("cost"), int) and link["cost"] > 0)):
+            problems.append("air link {} must have a positive integer cost"
+                            .format(i))
+
+        key = (min(a, b), max(a, b), link.get("type"))
+        if key in seen:
+            problems.append("link {} duplicates an earlier {} link between "
+                            "{} and {}".format(i, key[2], a, b))
+        seen.add(key)
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+
+    # Every city must be reachable from every other
+    if n:
+        reached = {0}
+        stack = [0]
+        while stack:
+            for city_id in neighbours[stack.pop()] - reached:
+                reached.add(city_id)
+                stack.append(city_id)
+        unreached = sorted(set(range(n)) - reached)
+        if unreached:
+            problems.append("cities {} cannot be reached from city 0".format(
+                unreached))
+
+    return problems
+
+
+def get_source_hash(source):
+    """Return the hash of a map file's contents that compiled maps are
+    checked against"""
+    return hashlib.sha256(source).hexdigest()
+
+
+def load_compiled(map_id, filename, source):
+    """Return the GameMap stored in the compiled file for a map file, or None
+    if there is no compiled file or it was compiled from a different version
+    of the map file, whose contents are given by source. Compiled files that
+    cannot be read, e.g. because they were written by an incompatible version
+    of this code, are also ignored"""
+    try:
+        with open(filename + COMPILED_SUFFIX, "rb") as compiled_file:
+            compiled = pickle.loads(compiled_file.read())
+    except (OSError, pickle.UnpicklingError, AttributeError, EOFError,
+            ImportError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+    if (not isinstance(compiled, dict) or
+            compiled.get("version") != COMPILED_VERSION or
+            compiled.get("source_hash") != get_source_hash(source) or
+            "map" not in compiled):
+        return None
+    return GameMap.from_compiled(map_id, compiled["map"])
+
+
+def get_map_filename(map_id):
+    """Return the path of the file the specified map is loaded from"""
+    if map_id not in MAPS:
+        raise UnknownMapException("No map with ID '{}'".format(map_id))
+    return os.path.join(MAP_DIRECTORY, MAPS[map_id].filename)
+
+
+def load_map(map_id):
+    """Load a map from its compiled file if that is up to date, or from its
+    map file otherwise, and return the GameMap object"""
+    filename = get_map_filename(map_id)
+    with open(filename, "rb") as map_file:
+        source = map_file.read()
+
+    game_map = load_compiled(map_id, filename, source)
+    if game_map is None:
+        game_map = GameMap(map_id, json.loads(source.decode()))
+    return game_map
+
+
+class MapRegistry(object):
+    """The maps loaded by this process. Maps are loaded when first requested
+    and kept under their ID and content hash, so every structure derived from
+    a map is built once per version of the map. At most max_maps are kept,
+    discarding the least recently used; a discarded map is loaded again the
+    next time it is requested"""
+
+    def __init__(self, max_maps=MAX_LOADED_MAPS):
+        self.max_maps = max_maps
+        self.maps = OrderedDict()  # (map ID, content hash) -> GameMap
+        self.content_hashes = {}  # Map ID -> content hash of latest version
+        self.lock = threading.Lock()
+
+    def get(self, map_id, content_hash=None):
+        """Return the GameMap for the specified map ID. If content_hash is
+        given, return None unless that is the latest loaded version"""
+        with self.lock:
+            key = (map_id, self.content_hashes.get(map_id))
+            if key not in self.maps:
+                game_map = load_map(map_id)
+                key = (map_id, game_map.content_hash)
+                self.content_hashes[map_id] = game_map.content_hash
+                self.maps[key] = game_map
+
+            self.maps.move_to_end(key)
+            while len(self.maps) > self.max_maps:
+                (evicted_id, evicted_hash), _ = self.maps.popitem(last=False)
+                if self.content_hashes.get(evicted_id) == evicted_hash:
+                    del self.content_hashes[evicted_id]
+
+            game_map = self.maps[key]
+
+        if content_hash is not None and content_hash != game_map.content_hash:
+            return None
+        return game_map
+
+
+# The maps loaded by this process
+map_registry = MapRegistry()
+
+
+def get_map(map_id):
+    """Return the GameMap object for the specified map ID, loading it if it
+    is not already loaded"""
+    return map_registry.get(map_id)
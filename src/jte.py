@@ -1,28 +1,43 @@
 import sys
 import json
 import random
-import time
-import copy
-from enum import Enum
+import hashlib
+from collections import namedtuple
+
+import bots
+from metrics import metrics
+from gamemap import LinkTypes, get_map
 
 
 class AuthenticationException(Exception):
     """There was a problem with authenticating the user"""
 
 
-class InvalidMoveException(Exception):
-    """The specifed move was not valid"""
-
-
 class InvalidActionException(Exception):
     """The specifed action was not valid"""
 
 
-class LinkTypes(Enum):
-    """An enum to store the availble types of link between cities"""
-    LAND = "land"
-    SEA = "sea"
-    AIR = "air"
+class TooManyPlayersException(Exception):
+    """There are not enough cards in the map to deal to every player"""
+
+
+class Action(namedtuple("Action", ["id", "type", "link"])):
+    """An action the current player can perform. id is the action's index in
+    Game.available_actions, type is one of the action constants in Game and
+    link is the Edge to travel along for travel actions, or None otherwise"""
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """Return a JSON-serialisable dictionary of the form:
+            {"id": <integer ID>,
+             "type": <action type>,
+             "link": <Edge.to_dict() output, for travel actions only>}
+        """
+        d = {"id": self.id, "type": self.type}
+        if self.link is not None:
+            d["link"] = self.link.to_dict()
+        return d
 
 
 class CircularQueue(object):
@@ -47,12 +62,39 @@ class CircularQueue(object):
         return item
 
 
+class GameRandom(object):
+    """A deterministic source of randomness for a game. Each result is derived
+    from the game's seed and the number of results produced so far, so the
+    whole state is two integers and can be saved and restored cheaply"""
+
+    __slots__ = ("seed", "count")
+
+    def __init__(self, seed, count=0):
+        self.seed = seed
+        self.count = count
+
+    def next_bytes(self):
+        """Return the next block of random bytes"""
+        data = "{}:{}".format(self.seed, self.count).encode()
+        self.count += 1
+        return hashlib.sha256(data).digest()
+
+    def randint(self, a, b):
+        """Return a random integer N such that a <= N <= b"""
+        n = int.from_bytes(self.next_bytes()[:8], "big")
+        return a + n % (b - a + 1)
+
+    def shuffle(self, items):
+        """Shuffle a list in place"""
+        random.Random(self.next_bytes()).shuffle(items)
+
+
 class CardDeck(object):
     """An object to represent a deck of cards"""
 
-    def __init__(self, cards):
+    def __init__(self, cards, rng=random):
         self.cards = cards
-        random.shuffle(self.cards)
+        rng.shuffle(self.cards)
 
     def deal(self):
         """Deal a card and remove it from the deck"""
@@ -67,47 +109,126 @@ class MessageLog(object):
     def __init__(self):
         self.messages = [None] * MessageLog.MAX_MESSAGES
         self.ptr = 0  # Index of the position to insert the next message into
+        self.next_id = 1  # Sequence number to give the next message
 
     def add(self, message_str):
         """Add a string to the log"""
         self.messages[self.ptr] = {
-            "message": message_str,
-            "timestamp": time.time()
+            "id": self.next_id,
+            "message": message_str
         }
+        self.next_id += 1
         self.ptr = (self.ptr + 1) % MessageLog.MAX_MESSAGES
-        time.sleep(0.05)
 
     def get_list(self):
         """Return a list of the messages in the log in order (oldest first)"""
         l = self.messages[self.ptr:] + self.messages[:self.ptr]
         return [i for i in l if i is not None]
 
+    def get_state(self):
+        """Return a tuple of the contents of the log. Messages are never
+        modified once added so they are not copied"""
+        return (tuple(self.messages), self.ptr, self.next_id)
+
+    def set_state(self, state):
+        """Restore the log to a state returned by get_state()"""
+        messages, self.ptr, self.next_id = state
+        self.messages = list(messages)
+
 
 class Player(object):
-    """A player in the game"""
+    """A player in the game.
+
+    The cities visited are kept as a list, in the order they were visited, and
+    as a bitmask with a bit for each of the player's cards, so that checking
+    whether a city has been visited or the player has won does not need to
+    search the list"""
+
+    __slots__ = ("name", "cities", "home_city", "cities_visited",
+                 "current_city", "waiting_at_port", "card_bits",
+                 "visited_mask")
 
     def __init__(self, name, starting_cities, home_city):
         self.name = name
         self.cities = starting_cities
         self.home_city = home_city
-        self.cities_visited = []
         self.current_city = self.home_city
         self.waiting_at_port = False
+        self.card_bits = {city: 1 << i for i, city in enumerate(self.cities)}
+        self.set_visited([])
+
+    def set_visited(self, cities_visited):
+        """Set the list of cities the player has visited"""
+        self.cities_visited = list(cities_visited)
+        self.visited_mask = 0
+        for city in self.cities_visited:
+            self.visited_mask |= self.card_bits[city]
+
+    def visit(self, city):
+        """Mark one of the player's cities as visited"""
+        self.cities_visited.append(city)
+        self.visited_mask |= self.card_bits[city]
+
+    def has_visited(self, city):
+        return bool(self.visited_mask & self.card_bits.get(city, 0))
+
+    def can_collect(self, city):
+        """Return True if reaching the city would count as visiting one of the
+        player's cities: it must be one they have not yet visited, and their
+        home city only counts once all the others have been visited"""
+        if city not in self.card_bits or self.has_visited(city):
+            return False
+        return (city != self.home_city or
+                len(self.cities_visited) == len(self.cities) - 1)
+
+    def has_won(self):
+        """Return True if the player has visited all of their cities"""
+        return self.visited_mask == (1 << len(self.cities)) - 1
+
+    def get_remaining_cities(self):
+        """Return the list of the player's cities they have not yet visited"""
+        return [c for c in self.cities
+                if not self.visited_mask & self.card_bits[c]]
+
+    def get_state(self):
+        """Return a tuple of the parts of the player that change during the
+        game"""
+        return (tuple(self.cities_visited), self.current_city,
+                self.waiting_at_port)
+
+    def set_state(self, state):
+        """Restore the player to a state returned by get_state()"""
+        cities_visited, self.current_city, self.waiting_at_port = state
+        self.set_visited(cities_visited)
 
 
 class Turn(object):
     """An object to represet a single turn taken by a player"""
 
+    __slots__ = ("dice_roll", "dice_points", "flown", "cities")
+
     def __init__(self, starting_city):
         self.dice_roll = None  # The score rolled on the dice
         self.dice_points = None  # The number of dice points remaining
         self.flown = False
         self.cities = [starting_city]
 
-    def roll_dice(self):
-        self.dice_roll = random.randint(1, 6)
+    def roll_dice(self, rng=random):
+        self.dice_roll = rng.randint(1, 6)
         self.dice_points = self.dice_roll
 
+    def get_state(self):
+        return (self.dice_roll, self.dice_points, self.flown,
+                tuple(self.cities))
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a Turn from a tuple returned by get_state()"""
+        turn = cls.__new__(cls)
+        turn.dice_roll, turn.dice_points, turn.flown, cities = state
+        turn.cities = list(cities)
+        return turn
+
 
 class Game(object):
     """An object to represent an actual game"""
@@ -117,29 +238,41 @@ class Game(object):
     TRAVEL_ACTION = "travel"
     WAIT_AT_PORT_ACTION = "wait_at_port"
 
-    def __init__(self, game_map, player_names):
-        """Create players and deal cards"""
+    # The number of previous versions of the status to keep for sending deltas
+    STATUS_HISTORY_LENGTH = 10
+
+    # The maximum number of actions computer-controlled players may perform
+    # between actions by human players
+    MAX_BOT_ACTIONS = 1000
+
+    def __init__(self, game_map, player_names, seed=None, bot_names=()):
+        """Create players and deal cards. game_map is a GameMap object. seed is
+        an integer that determines the cards dealt and all dice rolls; if not
+        given a random one is chosen. bot_names is a list of the names of the
+        players that are computer-controlled"""
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.rng = GameRandom(seed)
+        self.bot_names = list(bot_names)
+
+        # The (player index, action ID) pairs passed to perform_action() since
+        # the start of the game. Replaying these with the same seed recreates
+        # the game (see replay())
+        self.action_log = []
         self.in_progress = True
         self.game_map = game_map
-
-        # Build a list of sea ports
-        self.sea_ports = []
-        for link in self.game_map["links"]:
-            if link["type"] == LinkTypes.SEA.value:
-                self.sea_ports.append(link["cities"][0])
-                self.sea_ports.append(link["cities"][1])
-        self.sea_ports = set(self.sea_ports)
+        self.sea_ports = self.game_map.sea_ports
 
         self.players = []
 
-        city_ids = list(range(len(self.game_map["cities"])))
+        if len(player_names) > self.game_map.max_players:
+            raise TooManyPlayersException(
+                "A game on this map can have at most {} players".format(
+                    self.game_map.max_players))
 
-        # Seperate cities into the 3 decks
-        # Note: num. of cities should be a multiple of 3 for this to work properly
-        decks = []
-        l = int(len(city_ids) / 3)
-        for i in range(3):
-            decks.append(CardDeck(city_ids[i*l:(i+1)*l]))
+        # Shuffle a copy of each of the map's 3 decks
+        decks = [CardDeck(list(cards), self.rng) for cards in game_map.decks]
 
         # Deal 3 cards from each deck to each player
         for name in player_names:
@@ -152,10 +285,90 @@ class Game(object):
         self.winner = None
         self.available_actions = None
         self.status = None
+        self.version = 0  # Incremented each time the status changes
+        self.status_versions = {}  # Previous statuses, indexed by version
+        self.status_json_cache = {}
         self.message_log = MessageLog()
         self.next_player()
+        self.play_bots()
         self.update_status()
 
+    def __getstate__(self):
+        # Don't save cached JSON or old statuses - clients that ask for changes
+        # since a version from before the game was loaded get the full status
+        state = self.__dict__.copy()
+        state["status_versions"] = {}
+        state["status_json_cache"] = {}
+        return state
+
+    def save_state(self):
+        """Return a tuple of everything about the game that can change, which
+        can be passed to restore_state() to return the game to this point.
+        The map, cards and messages are never modified so are not copied,
+        making this O(number of players)"""
+        return (
+            self.in_progress,
+            self.winner,
+            tuple(p.get_state() for p in self.players),
+            self.players.index(self.current_player),
+            self.player_queue.current_index,
+            self.current_turn.get_state(),
+            self.message_log.get_state(),
+            self.rng.count,
+            len(self.action_log),
+            self.available_actions,
+            (self.version, self.status, self.actions_status,
+             self.cards_status)
+        )
+
+    def restore_state(self, state):
+        """Return the game to a state returned by save_state()"""
+        (self.in_progress, self.winner, players, current_player_index,
+         self.player_queue.current_index, turn, message_log, self.rng.count,
+         actions_performed, self.available_actions, status) = state
+
+        for player, player_state in zip(self.players, players):
+            player.set_state(player_state)
+
+        self.current_player = self.players[current_player_index]
+        self.current_turn = Turn.from_state(turn)
+        self.message_log.set_state(message_log)
+        del self.action_log[actions_performed:]
+
+        (self.version, self.status, self.actions_status,
+         self.cards_status) = status
+        for version in list(self.status_versions):
+            if version >= self.version:
+                del self.status_versions[version]
+        self.status_json_cache = {}
+
+    def clone(self):
+        """Return a copy of the game that can be changed independently of this
+        one. The map is shared"""
+        game = Game.__new__(Game)
+        game.__dict__.update(self.__dict__)
+        game.players = [Player(p.name, p.cities, p.home_city)
+                        for p in self.players]
+        game.player_queue = CircularQueue(game.players)
+        game.message_log = MessageLog()
+        game.rng = GameRandom(self.seed)
+        game.action_log = list(self.action_log)
+        game.status_versions = dict(self.status_versions)
+        game.restore_state(self.save_state())
+        return game
+
+    def apply(self, action_id):
+        """Perform an action as the current player without updating the status
+        or playing computer-controlled players, and return a value that can be
+        passed to undo() to reverse it"""
+        state = self.save_state()
+        self.apply_action(action_id)
+        return state
+
+    def undo(self, state):
+        """Reverse an action performed with apply()"""
+        self.restore_state(state)
+
     def next_player(self):
         """Advance the current_player counter"""
         if self.current_player is not None:
@@ -171,24 +384,19 @@ class Game(object):
         self.message_log.add(msg)
 
     def get_available_actions(self):
-        """Calculate and return the actions the current player is able to
-        perform. Each action is a dictionary of the form:
-            {"id": <integer ID>,
-             "type": <one of the constants at the top of this class>
-             ""}
-        """
+        """Calculate and return a tuple of the actions the current player is
+        able to perform, as Action objects. The ID of each action is its index
+        in the tuple"""
         if not self.in_progress:
-            return []
+            return ()
 
         actions = []
 
         if self.current_turn.dice_points is None and not self.current_player.waiting_at_port:
-            actions.append({"type": Game.ROLL_DICE_ACTION})
+            actions.append(Action(len(actions), Game.ROLL_DICE_ACTION, None))
 
         for link in self.get_links():
-            actions.append({
-                "type": Game.TRAVEL_ACTION, "link": link
-            })
+            actions.append(Action(len(actions), Game.TRAVEL_ACTION, link))
 
         # Allow waiting at port if player is at a sea port with dice points
         # remaining, but not at the start of their turn
@@ -196,41 +404,70 @@ class Game(object):
         if (at_port and self.current_turn.dice_points is not None and
             self.current_turn.dice_points != self.current_turn.dice_roll):
 
-            actions.append({"type": Game.WAIT_AT_PORT_ACTION})
+            actions.append(Action(len(actions), Game.WAIT_AT_PORT_ACTION,
+                                  None))
 
-        # Add IDs to each action
-        for i, action in enumerate(actions):
-            action["id"] = i
-
-        return actions
+        return tuple(actions)
 
     def perform_action(self, action_id, username):
-        """Perform an action as the player with the username provided"""
+        """Perform an action as the player with the username provided, followed
+        by the actions of any computer-controlled players whose turn it is
+        next"""
 
         if username != self.current_player.name:
-            msg = "It is not {}'s turn".format(player.name)
+            msg = "It is not {}'s turn".format(username)
             raise AuthenticationException(msg)
 
-        action = None
-        for i in self.available_actions:
-            if i["id"] == action_id:
-                action = i
+        with metrics.timer("engine_seconds", stage="apply_action"):
+            self.apply_action(action_id)
+        self.action_log.append((self.players.index(self.get_player(username)),
+                                action_id))
+
+        if self.bot_names:
+            with metrics.timer("engine_seconds", stage="play_bots"):
+                self.play_bots()
+
+        with metrics.timer("engine_seconds", stage="update_status"):
+            self.update_status()
+
+    @classmethod
+    def replay(cls, game_map, player_names, seed, action_log, bot_names=()):
+        """Create a game and perform the actions from another game's
+        action_log, returning a game in the same state as the original"""
+        game = cls(game_map, player_names, seed=seed, bot_names=bot_names)
+        for player_index, action_id in action_log:
+            game.perform_action(action_id, game.players[player_index].name)
+        return game
+
+    def play_bots(self):
+        """Perform actions for computer-controlled players until it is a human
+        player's turn or the game ends"""
+        for i in range(Game.MAX_BOT_ACTIONS):
+            if (not self.in_progress or
+                    self.current_player.name not in self.bot_names):
                 break
 
-        if action is None:
+            self.apply_action(bots.choose_action(self))
+
+    def apply_action(self, action_id):
+        """Perform an action as the current player"""
+        if (not isinstance(action_id, int) or
+                not 0 <= action_id < len(self.available_actions)):
             raise InvalidActionException("No action with that ID was found")
 
-        if action["type"] == Game.ROLL_DICE_ACTION:
+        action = self.available_actions[action_id]
+
+        if action.type == Game.ROLL_DICE_ACTION:
             self.roll_dice()
 
-        elif action["type"] == Game.TRAVEL_ACTION:
+        elif action.type == Game.TRAVEL_ACTION:
 
             if self.current_player.waiting_at_port:
                 self.current_player.waiting_at_port = False
 
-            self.travel_to(action["link"])
+            self.travel_to(action.link)
 
-        elif action["type"] == Game.WAIT_AT_PORT_ACTION:
+        elif action.type == Game.WAIT_AT_PORT_ACTION:
             self.current_player.waiting_at_port = True
             self.next_player()
 
@@ -243,10 +480,8 @@ class Game(object):
             self.next_player()
             self.available_actions = self.get_available_actions()
 
-        self.update_status()
-
     def roll_dice(self):
-        self.current_turn.roll_dice()
+        self.current_turn.roll_dice(self.rng)
 
         # Give the player another go if they rolled a 6
         if self.current_turn.dice_points == 6:
@@ -258,158 +493,194 @@ class Game(object):
 
     def get_links(self):
         """Return a list of links that the current player can travel along.
-        Each link is a dictionary of the form:
-            {"to_city": <destination city ID>,
-            "type": <link type>,
-            "cost": <link cost if type is "air">}
-        """
+        Each link is an Edge object from the game map"""
         player = self.current_player
+        turn = self.current_turn
         available_links = []
 
-        for link in self.game_map["links"]:
-            if player.current_city in link["cities"]:
+        # Only sea links can be taken before the dice has been rolled, and
+        # only land and air links after. Air links cannot be taken if already
+        # flown this turn
+        if turn.dice_points is None:
+            link_types = [LinkTypes.SEA]
+        elif turn.flown:
+            link_types = [LinkTypes.LAND]
+        else:
+            link_types = [LinkTypes.LAND, LinkTypes.AIR]
 
-                # Skip if dice has not been rolled and this is not a sea link
-                if (self.current_turn.dice_points is None and
-                        link["type"] != LinkTypes.SEA.value):
-                    continue
-
-                # Skip if dice has been rolled and this is a sea link
-                if (self.current_turn.dice_points is not None and
-                        link["type"] == LinkTypes.SEA.value):
-                    continue
-
-                # Skip if already flown this turn and this is an air link
-                if (link["type"] == LinkTypes.AIR.value and
-                        self.current_turn.flown):
-                    continue
+        for link_type in link_types:
+            for link in self.game_map.links_from(player.current_city,
+                                                 link_type):
 
                 # Skip if not enough dice points are remaining
-                if ("cost" in link and
-                        link["cost"] > self.current_turn.dice_points):
+                if link.cost is not None and link.cost > turn.dice_points:
                     continue
 
-                # Work out the 'to' city - the city in the link that is not the
-                # player's current city
-                if link["cities"][0] == player.current_city:
-                    to_city = link["cities"][1]
-                else:
-                    to_city = link["cities"][0]
-
                 # Skip if the to city has already been visited this turn
-                if to_city in self.current_turn.cities:
+                if link.to_city in turn.cities:
                     continue
 
-                link["to_city"] = to_city
-
                 # If reached here then the link must be okay
                 available_links.append(link)
 
         return available_links
 
     def travel_to(self, link):
-        """Move the current player along the link provided"""
-
-        # Check this move is valid
-        if link not in self.get_links():
-            raise InvalidMoveException("That is not a valid move")
-
+        """Move the current player along the link provided. The link must be
+        from one of the available actions, which apply_action() checks"""
         current_city_str = self.get_city_name(self.current_player.current_city)
-        to_city_str = self.get_city_name(link["to_city"])
+        to_city_str = self.get_city_name(link.to_city)
         msg = "{}: {} -> {}".format(self.current_player.name, current_city_str,
                                     to_city_str)
         self.message_log.add(msg)
 
-        self.current_player.current_city = link["to_city"]
-        self.current_turn.cities.append(link["to_city"])
+        self.current_player.current_city = link.to_city
+        self.current_turn.cities.append(link.to_city)
 
         end_turn = False
 
-        if link["to_city"] in self.current_player.cities:
-            p = self.current_player
-
-            # Work out whether the player has visited all cities except their
-            # home city
-            visited_all = (list(set(p.cities) - set(p.cities_visited))
-                           == [p.home_city])
-
-            already_visited = link["to_city"] in self.current_player.cities_visited
-
-            if not already_visited and (link["to_city"] != p.home_city or visited_all):
-
-                msg = "{} got a city".format(self.current_player.name)
-                self.message_log.add(msg)
+        if self.current_player.can_collect(link.to_city):
+            msg = "{} got a city".format(self.current_player.name)
+            self.message_log.add(msg)
 
-                self.current_player.cities_visited.append(link["to_city"])
+            self.current_player.visit(link.to_city)
 
-                # End turn when reaching a city - strictly this is not part of
-                # the rules of the game but it's how me and Ivan play it...
-                end_turn = True
+            # End turn when reaching a city - strictly this is not part of
+            # the rules of the game but it's how me and Ivan play it...
+            end_turn = True
 
         self.win_check()
 
         if self.in_progress:
-            if link["type"] == LinkTypes.AIR.value:
-                self.current_turn.dice_points -= int(link["cost"])
+            if link.type == LinkTypes.AIR:
+                self.current_turn.dice_points -= link.cost
                 self.current_turn.flown = True
 
-            elif link["type"] == LinkTypes.LAND.value:
+            elif link.type == LinkTypes.LAND:
                 self.current_turn.dice_points -= 1
 
-            elif link["type"] == LinkTypes.SEA.value:
+            elif link.type == LinkTypes.SEA:
                 end_turn = True
 
             # End turn now if all dice points are used up
             if self.current_turn.dice_points == 0 or end_turn:
                 self.next_player()
 
+    def get_player(self, name):
+        """Return the Player object with the name provided, or None if there is
+        no such player"""
+        for player in self.players:
+            if player.name == name:
+                return player
+        return None
+
     def get_city_name(self, city_id):
-        return self.game_map["cities"][city_id]["name"]
+        return self.game_map.get_city_name(city_id)
 
     def win_check(self):
-        for player in self.players:
-            if set(player.cities_visited) == set(player.cities):
-                self.end_game(player)
+        # Only the current player can have visited a city since the last check
+        if self.current_player.has_won():
+            self.end_game(self.current_player)
 
     def end_game(self, winner):
         self.in_progress = False
         self.message_log.add("{} has won!".format(winner.name))
         self.winner = winner.name
 
-    def get_status(self, username):
-        """Return the status as set in update_status(). username is the name of the user
-        retreiving the status"""
+    def get_status(self, username, since=None):
+        """Return the status as set in update_status(). username is the name of
+        the user retreiving the status.
 
-        # Copy the status so some things can be removed
-        status = copy.deepcopy(self.status)
+        If since is given and is a recent version number, return only the
+        fields of the public status that have changed since that version, the
+        messages added since then, and "delta": True. Otherwise return the full
+        status"""
+        status = dict(self.get_public_status(since))
+        status.update(self.get_private_status(username, "players" in status))
+        return status
 
-        # Put this player's cards in top level in the status dict
-        for p in status["players"]:
-            if p["name"] == username:
-                status["my_cards"] = p["cards"]
+    def get_status_json(self, username, since=None):
+        """Return the same status as get_status() encoded as JSON bytes. The
+        public part of the status is only encoded once per version"""
+        key = since if since in self.status_versions else None
 
-        # Only show actions if it is that player's turn
-        if username != self.current_player.name:
-            del status["actions"]
+        if key not in self.status_json_cache:
+            public = self.get_public_status(key)
+            self.status_json_cache[key] = (json.dumps(public).encode(),
+                                           "players" in public)
 
-        return status
+        public_json, players_changed = self.status_json_cache[key]
+        private = self.get_private_status(username, players_changed)
+        if not private:
+            return public_json
+
+        private_json = json.dumps(private).encode()
+        return public_json[:-1] + b", " + private_json[1:]
+
+    def get_public_status(self, since=None):
+        """Return the status shared by all players, or the changes to it since
+        the version given (see get_status()). The returned dictionary must not
+        be modified"""
+        if since is None or since not in self.status_versions:
+            return self.status
+
+        old_status, old_message_id = self.status_versions[since]
+        delta = {"delta": True}
 
+        for key, value in self.status.items():
+            if key != "message_log" and old_status.get(key) != value:
+                delta[key] = value
+
+        delta["message_log"] = [m for m in self.status["message_log"]
+                                if m["id"] > old_message_id]
+        return delta
+
+    def get_private_status(self, username, include_cards=True):
+        """Return a dictionary of the parts of the status that are specific to
+        the user provided: their cards, and the available actions if it is
+        their turn"""
+        private = {}
+
+        if include_cards and username in self.cards_status:
+            private["my_cards"] = self.cards_status[username]
+
+        # Only show actions if it is that player's turn
+        if username == self.current_player.name:
+            private["actions"] = self.actions_status
+
+        return private
 
     def update_status(self):
         """Set the current status to a  dictionary containing all information a
-        client will need to provide and interface for the game.
+        client will need to provide and interface for the game, and increment
+        the version number. The previous STATUS_HISTORY_LENGTH statuses are kept
+        so that changes since then can be sent to clients
         """
+        if self.status is not None:
+            # The messages added since the old status was built are not in its
+            # message log, so take the last message ID from the log itself
+            messages = self.status["message_log"]
+            last_message_id = messages[-1]["id"] if messages else 0
+            self.status_versions[self.version] = (self.status, last_message_id)
+            self.status_versions.pop(self.version - Game.STATUS_HISTORY_LENGTH,
+                                     None)
+
+        self.version += 1
+        self.status_json_cache = {}
         self.status = {
+            "version": self.version,
             "in_progress": self.in_progress,
             "winner": None if self.in_progress else self.winner,
             "current_player": self.current_player.name,
             "dice_roll": self.current_turn.dice_roll,
             "dice_points": self.current_turn.dice_points,
             "players": [],
-            "message_log": self.message_log.get_list(),
-            "actions": self.available_actions
+            "message_log": self.message_log.get_list()
         }
 
+        self.actions_status = [a.to_dict() for a in self.available_actions]
+
+        self.cards_status = {}
         for p in self.players:
             progress_str = "{}/{}".format(len(p.cities_visited), len(p.cities))
             player_status = {
@@ -422,20 +693,19 @@ class Game(object):
             for city in p.cities:
                 player_status["cards"].append({
                     "id": city,
-                    "visited": (city in p.cities_visited)
+                    "visited": p.has_visited(city)
                 })
 
             self.status["players"].append(player_status)
-
-        self.status["timestamp"] = time.time()
+            self.cards_status[p.name] = player_status["cards"]
 
 
 if __name__ == "__main__":
 
-    with open("map.json") as map_file:
-        soton_map = json.load(map_file)
+    soton_map = get_map("southampton")
 
-    players = ["John", "Yoko"]
+    # The Southampton map only has enough cards for one player
+    players = ["John", "Yoko"][:soton_map.max_players]
     game = Game(soton_map, players)
 
     for i, name in enumerate(players):
@@ -463,18 +733,17 @@ if __name__ == "__main__":
         print("Available actions are:")
 
         for action in game.available_actions:
-            if action["type"] == Game.ROLL_DICE_ACTION:
+            if action.type == Game.ROLL_DICE_ACTION:
                 desc = "Roll dice"
 
-            elif action["type"] == Game.TRAVEL_ACTION:
-                city = game.get_city_name(action["link"]["to_city"])
-                desc = "Travel to {} by {}".format(city,
-                                                   action["link"]["type"])
+            elif action.type == Game.TRAVEL_ACTION:
+                city = game.get_city_name(action.link.to_city)
+                desc = "Travel to {} by {}".format(city, action.link.type.value)
 
-            elif action["type"] == Game.WAIT_AT_PORT_ACTION:
+            elif action.type == Game.WAIT_AT_PORT_ACTION:
                 desc = "Wait at port"
 
-            print("{}. {}".format(action["id"], desc))
+            print("{}. {}".format(action.id, desc))
 
         choice = int(input())
         game.perform_action(choice, username)
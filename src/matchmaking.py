@@ -13,13 +13,16 @@ class Matchmaker(object):
     """An object to facilitate creating a Game object for a game between
     multiple players who join the game at different times"""
 
-    def __init__(self, no_of_players, game_map):
+    def __init__(self, no_of_players, game_map, no_of_bots=0):
         self.no_of_players = no_of_players
         self.game_map = game_map
         self.game = None
 
+        # Computer-controlled players take their seats straight away
+        self.bot_names = ["Bot {}".format(i + 1) for i in range(no_of_bots)]
+
         # A list of usernames of the user that have joined so far
-        self.player_names = []
+        self.player_names = list(self.bot_names)
 
     def add_player(self, name):
         if self.game is not None:
@@ -35,7 +38,8 @@ class Matchmaker(object):
         self.player_names.append(name)
 
         if len(self.player_names) == self.no_of_players:
-            self.game = Game(self.game_map, self.player_names)
+            self.game = Game(self.game_map, self.player_names,
+                             bot_names=self.bot_names)
 
     def get_status(self):
         """Return a dictionary containing all status information necessary for a
@@ -0,0 +1,198 @@
+"""Counters and latency histograms for the server and game engine.
+
+Recording is off until metrics.enabled is set, so that the game engine can
+be used elsewhere (e.g. by simulate.py) without paying for it. Metrics are
+rendered in the Prometheus text format by Metrics.render().
+
+RequestProfiler is an opt-in sampling profiler for requests.
+"""
+import io
+import time
+import pstats
+import random
+import cProfile
+import threading
+
+
+# Upper bounds in seconds of the buckets latencies are counted in
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    """Counts of observed values in each of BUCKETS, along with their total"""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+
+
+class Timer(object):
+    """A context manager that records the time spent inside it in a
+    histogram"""
+
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start,
+                             **self.labels)
+
+
+class NullTimer(object):
+    """A context manager that does nothing, used when metrics are disabled"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    """A set of counters and histograms, each identified by a name and a
+    dictionary of labels"""
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """Add to a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def timer(self, name, **labels):
+        """Return a context manager that records the time spent inside it in
+        a histogram"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def add_gauge(self, name, func):
+        """Register a function that returns the current value of a gauge when
+        metrics are rendered"""
+        self.gauges[name] = func
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = ["uptime_seconds {:.3f}".format(time.time() - self.start_time)]
+
+        for name, func in sorted(self.gauges.items()):
+            lines.append("{} {}".format(name, func()))
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{}{} {}".format(name, format_labels(labels),
+                                              value))
+
+            for (name, labels), hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", bound),)
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(bucket_labels), cumulative))
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(labels + (("le", "+Inf"),)),
+                    hist.count))
+                lines.append("{}_sum{} {:.6f}".format(
+                    name, format_labels(labels), hist.total))
+                lines.append("{}_count{} {}".format(
+                    name, format_labels(labels), hist.count))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+# The metrics for this process
+metrics = Metrics()
+
+
+class RequestProfiler(object):
+    """Profiles a random sample of requests with cProfile and accumulates the
+    results. rate is the fraction of requests to profile. Only one request is
+    profiled at a time, since profilers in different threads interfere"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.stats = None
+        self.profiled = 0
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+
+    def start(self):
+        """Return a running cProfile.Profile object if this request has been
+        chosen to be profiled, or None otherwise"""
+        if random.random() >= self.rate or not self.active.acquire(False):
+            return None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        """Stop a profile returned by start() and add it to the results"""
+        profile.disable()
+        self.active.release()
+
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+
+    def get_report(self, limit=50):
+        """Return the accumulated results, sorted by cumulative time, as
+        text"""
+        stream = io.StringIO()
+        with self.lock:
+            stream.write("{} requests profiled\n".format(self.profiled))
+            if self.stats is not None:
+                self.stats.stream = stream
+                self.stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
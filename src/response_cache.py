@@ -0,0 +1,107 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from metrics import metrics
+
+
+class CachedResponse(object):
+    """An encoded response body along with its gzipped form and an ETag. A
+    body of None represents an empty 204 response"""
+
+    # Bodies shorter than this many bytes are not worth compressing
+    GZIP_MIN_SIZE = 500
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = None
+        if body is not None:
+            self.etag = hashlib.sha1(body).hexdigest()[:16]
+            if len(body) >= CachedResponse.GZIP_MIN_SIZE:
+                self.gzipped = gzip.compress(body, 6)
+
+    def encode(self, accept_encoding=None, if_none_match=None):
+        """Return the status code, a list of (name, value) headers and the body
+        to send, given the values of the Accept-Encoding and If-None-Match
+        request headers (or None if they were not sent). The body is gzipped
+        if the client accepts it, and a 304 is returned if the client already
+        has it"""
+        if self.body is None:
+            return 204, [], b""
+
+        if (self.gzipped is not None and
+                parse_accept_header(accept_encoding)["gzip"]):
+            body = self.gzipped
+            etag = self.etag + "-gzip"
+            headers = [("Content-Encoding", "gzip")]
+        else:
+            body = self.body
+            etag = self.etag
+            headers = []
+
+        # Clients must check with the server before reusing a response, but
+        # can do so with If-None-Match to get a 304 if it is unchanged
+        headers += [("ETag", quote_etag(etag)),
+                    ("Cache-Control", "no-cache"),
+                    ("Vary", "Accept-Encoding, Cookie")]
+
+        if parse_etags(if_none_match).contains(etag):
+            return 304, headers, b""
+
+        headers.append(("Content-Type", "text/html; charset=utf-8"))
+        return 200, headers, body
+
+    def make_response(self, request):
+        """Return a Flask response for the request provided"""
+        status, headers, body = self.encode(
+            request.headers.get("Accept-Encoding"),
+            request.headers.get("If-None-Match")
+        )
+        return Response(body, status, headers)
+
+
+class ResponseCache(object):
+    """A cache of encoded responses for each game. Entries for a game are
+    tagged with its revision (see GameStore.get_revision()) and discarded as
+    soon as a different revision is seen, so a cached response is never
+    returned after the game has changed. Responses are cached for at most
+    max_games games, discarding the least recently used"""
+
+    def __init__(self, max_games=1000):
+        self.max_games = max_games
+        self.games = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, game_id, revision, key):
+        """Return the CachedResponse stored under key for the specified
+        revision of a game, or None if there is none"""
+        with self.lock:
+            entry = self.games.get(game_id)
+            cached = None
+            if entry is not None and entry[0] == revision:
+                self.games.move_to_end(game_id)
+                cached = entry[1].get(key)
+
+        metrics.increment("response_cache_lookups_total",
+                          result="miss" if cached is None else "hit")
+        return cached
+
+    def put(self, game_id, revision, key, body):
+        """Store a response body under key for the specified revision of a
+        game and return its CachedResponse"""
+        cached = CachedResponse(body)
+        with self.lock:
+            entry = self.games.get(game_id)
+            if entry is None or entry[0] != revision:
+                entry = (revision, {})
+                self.games[game_id] = entry
+            entry[1][key] = cached
+
+            self.games.move_to_end(game_id)
+            while len(self.games) > self.max_games:
+                self.games.popitem(last=False)
+        return cached
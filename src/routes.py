@@ -0,0 +1,100 @@
+"""Shortest routes between cities, measured in dice points.
+
+Distances between every pair of cities are calculated once per map with
+Dijkstra's algorithm from each city and cached with the map, so looking up a
+distance is a table lookup.
+
+Land links cost 1 dice point and air links cost the cost given in the map.
+Sea links cost no dice points but can only be taken at the start of a turn
+and end the turn, so crossing one costs a whole turn; this is counted as the
+average dice roll, SEA_COST.
+"""
+import heapq
+
+from gamemap import LinkTypes
+
+
+# The number of dice points a sea crossing is counted as
+SEA_COST = 3.5
+
+
+class RouteTable(object):
+    """All-pairs shortest distances and routes for a map"""
+
+    def __init__(self, game_map):
+        self.game_map = game_map
+        n = len(game_map.cities)
+
+        # distances[a][b] is the cost of the cheapest route from a to b, and
+        # next_city[a][b] the first city after a on that route. Unreachable
+        # cities have a distance of None. Compiled maps come with the tables
+        # already calculated (see compile_maps.py)
+        if game_map.route_tables is not None:
+            self.distances, self.next_city = game_map.route_tables
+            return
+
+        self.distances = []
+        self.next_city = []
+        for source in range(n):
+            distances, next_city = self.dijkstra(source)
+            self.distances.append(distances)
+            self.next_city.append(next_city)
+
+    def get_cost(self, link):
+        """Return the cost of travelling along an Edge"""
+        if link.type == LinkTypes.SEA:
+            return SEA_COST
+        if link.type == LinkTypes.AIR:
+            return link.cost
+        return 1
+
+    def dijkstra(self, source):
+        """Return lists of the distance to each city from the source city and
+        the first city on the route there"""
+        n = len(self.game_map.cities)
+        distances = [None] * n
+        next_city = [None] * n
+        distances[source] = 0
+        next_city[source] = source
+
+        queue = [(0, source)]
+        while queue:
+            distance, city = heapq.heappop(queue)
+            if distance > distances[city]:
+                continue
+
+            for link_type in LinkTypes:
+                for link in self.game_map.links_from(city, link_type):
+                    new_distance = distance + self.get_cost(link)
+                    to_city = link.to_city
+
+                    if (distances[to_city] is None or
+                            new_distance < distances[to_city]):
+                        distances[to_city] = new_distance
+                        next_city[to_city] = (to_city if city == source
+                                              else next_city[city])
+                        heapq.heappush(queue, (new_distance, to_city))
+
+        return distances, next_city
+
+    def get_distance(self, from_city, to_city):
+        """Return the number of dice points needed to travel between two
+        cities, or None if there is no route"""
+        return self.distances[from_city][to_city]
+
+    def get_route(self, from_city, to_city):
+        """Return the list of cities on the cheapest route between two cities,
+        including both ends, or None if there is no route"""
+        if self.distances[from_city][to_city] is None:
+            return None
+
+        route = [from_city]
+        while route[-1] != to_city:
+            route.append(self.next_city[route[-1]][to_city])
+        return route
+
+
+def get_route_table(game_map):
+    """Return the RouteTable for the map provided, calculating it if this is
+    the first time it has been requested"""
+    return game_map.get_derived("route_table", RouteTable)
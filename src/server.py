@@ -1,30 +1,162 @@
 import os
-import random
+import gzip
 import json
 import time
-import pickle
+import hashlib
 
-from flask import Flask, render_template, request, redirect, abort, session
+from flask import (Flask, Response, render_template, request, redirect, abort,
+                   session, g)
+from werkzeug.routing import BaseConverter
 
+from gamemap import MAPS, get_map, map_registry, UnknownMapException
+from jte import AuthenticationException, InvalidActionException
 from matchmaking import Matchmaker, InvalidNameException, GameFullException
+from metrics import metrics, RequestProfiler
+from response_cache import ResponseCache
+from routes import get_route_table
+from store import (GameStore, EventLogDirectoryBackend, GameNotFoundException,
+                   GAME_ID_REGEX)
+
+
+class GameIdConverter(BaseConverter):
+    """A URL converter that only matches strings in the form of game IDs, so
+    that other names in the games directory are never looked up"""
+    regex = GAME_ID_REGEX
 
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+app.url_map.converters["game_id"] = GameIdConverter
+
+# The secret key must be the same for every worker process so that sessions
+# created by one are accepted by the others
+app.secret_key = os.environ.get("JTE_SECRET_KEY") or os.urandom(24)
+
+# The maximum number of games that can exist at once
+MAX_GAMES = 10000
+
+# The maximum number of seconds a status request may be held open for
+LONG_POLL_TIMEOUT = 25
+
+GAME_FILES_DIRECTORY = os.environ.get("JTE_GAMES_DIR", "./games")
+
+# Set when running multiple worker processes that share the games directory
+SHARED_STATE = os.environ.get("JTE_SHARED_STATE", "") not in ("", "0")
+
+# Games that have not been updated for this many seconds are deleted
+GAME_TTL = int(os.environ.get("JTE_GAME_TTL", 3 * 60 * 60))
+
+# Map JSON URLs contain a hash of the content, so responses can be cached for
+# as long as browsers allow
+MAP_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Set to 0 to turn off recording metrics (see metrics.py)
+metrics.enabled = os.environ.get("JTE_METRICS", "1") != "0"
+
+# The fraction of requests to profile with cProfile, for /metrics/profile/
+PROFILE_RATE = float(os.environ.get("JTE_PROFILE_RATE", 0))
+profiler = RequestProfiler(PROFILE_RATE) if PROFILE_RATE > 0 else None
+
+# Addresses allowed to see metrics
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+game_store = GameStore(EventLogDirectoryBackend(GAME_FILES_DIRECTORY),
+                       shared=SHARED_STATE)
+game_store.start_reaper(GAME_TTL)
+
+# Encoded status responses for the latest revision of each game
+status_cache = ResponseCache()
+
+for name, value in game_store.get_stats().items():
+    metrics.add_gauge("store_" + name,
+                      lambda name=name: game_store.get_stats()[name])
+
+# The map used if the create game form does not choose one
+DEFAULT_MAP = "europe"
+
+# The username that spectators see the game as. No player has this name, so
+# spectators are shown no cards or actions
+SPECTATOR = None
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start() if profiler else None
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Record the time taken to handle the request and its status code"""
+    if g.get("profile") is not None:
+        profiler.stop(g.profile)
+        g.profile = None
+
+    if "request_start" in g:
+        record_request(request.endpoint, response.status_code,
+                       time.perf_counter() - g.request_start)
+    return response
+
+
+def record_request(endpoint, status_code, duration):
+    metrics.observe("http_request_seconds", duration, route=endpoint)
+    metrics.increment("http_responses_total", route=endpoint,
+                      status=status_code)
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Return metrics for this process as plain text. Only available to
+    requests from the local machine"""
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain")
+
 
-MAX_GAME_ID = 100
-GAME_FILES_DIRECTORY = "./games"
+@app.route("/metrics/profile/")
+def get_profile():
+    """Return the accumulated cProfile results for sampled requests, if
+    profiling is enabled. Only available to requests from the local
+    machine"""
+    if request.remote_addr not in LOCAL_ADDRESSES or profiler is None:
+        abort(404)
+    return Response(profiler.get_report(), mimetype="text/plain")
+
+
+@app.errorhandler(GameNotFoundException)
+def game_not_found(e):
+    """Return a 404 if a game is deleted while handling a request for it"""
+    return str(e), 404
+
+
+_static_hashes = {}
+
+
+@app.context_processor
+def template_functions():
+    return {"static_url": static_url}
 
-if not os.path.isdir(GAME_FILES_DIRECTORY):
-    os.mkdir(GAME_FILES_DIRECTORY)
 
-with open("europe-map.json") as map_file:
-    europe_map = json.load(map_file)
+def static_url(filename):
+    """Return the URL of a static file with a hash of its content in the query
+    string, so that browsers fetch it again only when it changes"""
+    if filename not in _static_hashes:
+        with app.open_resource(os.path.join("static", filename)) as f:
+            _static_hashes[filename] = hashlib.sha256(f.read()).hexdigest()[:16]
+    return "/static/{}?v={}".format(filename, _static_hashes[filename])
+
+
+def get_map_encodings(game_map):
+    """Return a dictionary mapping content encodings to the map's client JSON
+    in that encoding. The JSON is compressed once per loaded map"""
+    return game_map.get_derived("encodings", lambda m: {
+        "identity": m.client_json,
+        "gzip": gzip.compress(m.client_json, 9)
+    })
 
 
 def check_game_exists(game_id):
     """Check if a game with the specifed ID exists"""
-    if str(game_id) not in os.listdir(GAME_FILES_DIRECTORY):
+    if not game_store.exists(game_id):
         abort(404)
 
 
@@ -37,7 +169,8 @@ def home_redirect():
 @app.route("/create/")
 def create_game():
     """Render the static page for a user to create a new game"""
-    return render_template("create_game.html")
+    return render_template("create_game.html", maps=MAPS,
+                           default_map=DEFAULT_MAP)
 
 
 @app.route("/create/", methods=["POST"])
@@ -45,34 +178,45 @@ def create_game_post():
     """Handle a POST request from the create game page to actually create the
     game. Return a redirect to the join page for the newly created game"""
 
-    if len(os.listdir(GAME_FILES_DIRECTORY)) >= MAX_GAME_ID:
+    if game_store.count() >= MAX_GAMES:
         return "Too many games in progress", 503
 
-    while True:
-        game_id = random.randint(1, MAX_GAME_ID)
-
-        if str(game_id) not in os.listdir(GAME_FILES_DIRECTORY):
-            break
-
     try:
         players = int(request.form["no_of_players"])
     except (ValueError, KeyError):
         return "Must provide integer value 'no_of_players'", 400
 
-    m = Matchmaker(players, europe_map)
-    save_matchmaker(game_id, m)
+    try:
+        bots = int(request.form.get("no_of_bots") or 0)
+    except ValueError:
+        return "'no_of_bots' must be an integer", 400
+
+    if not 0 <= bots < players:
+        return "There must be at least one human player", 400
+
+    try:
+        game_map = get_map(request.form.get("map") or DEFAULT_MAP)
+    except UnknownMapException as e:
+        return str(e), 400
+
+    if players > game_map.max_players:
+        return "There can be at most {} players on that map".format(
+            game_map.max_players), 400
+
+    m = Matchmaker(players, game_map, no_of_bots=bots)
+    game_id = game_store.create(m)
 
     return redirect("/join/{}/".format(game_id))
 
 
-@app.route("/join/<int:game_id>/")
+@app.route("/join/<game_id:game_id>/")
 def join_game(game_id):
     """Render the page for a user to join a game"""
     check_game_exists(game_id)
     return render_template("join_game.html")
 
 
-@app.route("/join/<int:game_id>/", methods=["POST"])
+@app.route("/join/<game_id:game_id>/", methods=["POST"])
 def joing_game_post(game_id):
     """Handle a POST request from the join page to actually add the user to the
     game"""
@@ -90,26 +234,59 @@ def joing_game_post(game_id):
 
     name = name[0].upper() + name[1:].lower()
 
-    m = get_matchmaker(game_id)
+    with game_store.lock(game_id):
+        m = game_store.get(game_id)
 
-    try:
-        m.add_player(name)
-    except (InvalidNameException, GameFullException) as e:
-        return str(e), 400
+        try:
+            m.add_player(name)
+        except (InvalidNameException, GameFullException) as e:
+            return str(e), 400
+
+        game_store.save(game_id, m)
 
-    save_matchmaker(game_id, m)
     session[game_id] = name
 
     return "", 200
 
 
-@app.route("/join/<int:game_id>/status/")
+@app.route("/join/<game_id:game_id>/status/")
 def join_game_status(game_id):
-    """Return the matchmaking status of the specified game as JSON"""
+    """Return the matchmaking status of the specified game as JSON.
+
+    If the 'players' and 'wait' query parameters are given, wait up to 'wait'
+    seconds for the number of players who have joined to differ from
+    'players' before returning"""
     check_game_exists(game_id)
-    m = get_matchmaker(game_id)
-    status = m.get_status()
-    return json.dumps(status)
+
+    players = request.args.get("players", type=int)
+    wait = get_long_poll_wait()
+
+    if players is not None and wait:
+        game_store.wait_for_change(
+            game_id, lambda latest: len(latest.player_names) != players, wait
+        )
+
+    return load_join_status(game_id).make_response(request)
+
+
+def load_join_status(game_id):
+    """Return the CachedResponse for the matchmaking status of a game"""
+    cached = status_cache.get(game_id, game_store.get_revision(game_id),
+                              "join")
+    if cached is None:
+        with game_store.lock(game_id):
+            status = game_store.get(game_id).get_status()
+            cached = status_cache.put(game_id,
+                                      game_store.get_revision(game_id),
+                                      "join", json.dumps(status).encode())
+    return cached
+
+
+def get_long_poll_wait():
+    """Return the number of seconds to hold a status request open for, as
+    given by the 'wait' query parameter"""
+    wait = request.args.get("wait", 0, type=float)
+    return max(0, min(wait, LONG_POLL_TIMEOUT))
 
 
 def get_username(game_id):
@@ -122,68 +299,184 @@ def get_username(game_id):
 
     return session[game_id]
 
-def get_matchmaker(game_id):
-    """Unpickle and return the Matchmaker object for the specifed game"""
-    filename = os.path.join(GAME_FILES_DIRECTORY, str(game_id))
-    with open(filename, "rb") as f:
-        m = pickle.load(f)
-
-    return m
-
-
-def save_matchmaker(game_id, matchmaker):
-    """Pickle the Matchmaker object provided to a file"""
-    filename = os.path.join(GAME_FILES_DIRECTORY, str(game_id))
-    with open(filename, "wb") as f:
-        pickle.dump(matchmaker, f)
-
-
-@app.route("/play/<int:game_id>/")
+@app.route("/play/<game_id:game_id>/")
 def play_game(game_id):
     """Render the page to actually play the game"""
     check_game_exists(game_id)
-    m = get_matchmaker(game_id)
+    m = game_store.get(game_id)
 
     if not m.get_status()["ready"]:
         abort(403)
 
     username = get_username(game_id)
+    return render_game_page(m.game, username)
+
+
+@app.route("/watch/<game_id:game_id>/")
+def watch_game(game_id):
+    """Render the page for a spectator to watch a game without taking part.
+    Anyone can watch a game once it has started"""
+    check_game_exists(game_id)
+    check_game_ready(game_id)
+    return render_game_page(game_store.get(game_id).game, SPECTATOR)
+
+
+def render_game_page(game, username):
+    """Render the game page for a game as seen by the user given"""
+    game_map = game.game_map
+    map_url = "/map/{}/{}.json".format(game_map.map_id, game_map.content_hash)
+    return render_template("game.html", username=username, map_url=map_url,
+                           map_image=game_map.info.image)
+
+
+@app.route("/map/<map_id>/<content_hash>.json")
+def get_map_json(map_id, content_hash):
+    """Return the cities and airports of a map as JSON, gzipped if the client
+    accepts it. The response can be cached indefinitely since the URL changes
+    whenever the map does"""
+    try:
+        game_map = map_registry.get(map_id, content_hash)
+    except UnknownMapException:
+        abort(404)
+
+    if game_map is None:
+        abort(404)
+
+    encoding = "gzip" if request.accept_encodings["gzip"] else "identity"
+    response = Response(get_map_encodings(game_map)[encoding],
+                        mimetype="application/json")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
 
-    return render_template("game.html", username=username,
-                           cities=json.dumps(m.game.game_map["cities"]),
-                           airports=json.dumps(m.game.game_map["airports"]),
-                           random_num=time.time())
+    response.headers["Cache-Control"] = MAP_CACHE_CONTROL
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag("{}-{}".format(content_hash, encoding))
+    return response.make_conditional(request)
 
 
-@app.route("/play/<int:game_id>/status/<float:timestamp>/")
-def get_game_status(game_id, timestamp):
+@app.route("/play/<game_id:game_id>/status/<int:version>/")
+def get_game_status(game_id, version):
     """Return the game status as JSON. If the latest status for the game is
-    not newer than the timestamp provided, return a 204"""
+    not newer than the version provided, return a 204. Otherwise only the
+    changes since that version are returned if possible (see
+    Game.get_status()).
+
+    If the 'wait' query parameter is given, wait up to that many seconds for
+    a newer status before returning a 204.
+
+    Responses are cached until the game is next saved, so repeated requests
+    are answered (or given a 304 if the client sends a matching
+    If-None-Match header) without loading the game"""
     check_game_exists(game_id)
-    m = get_matchmaker(game_id)
+    return game_status_response(game_id, get_username(game_id), version)
 
-    if not m.get_status()["ready"]:
+
+@app.route("/watch/<game_id:game_id>/status/<int:version>/")
+def get_spectator_status(game_id, version):
+    """Return the game status as seen by spectators, i.e. without any
+    player's cards or actions. Otherwise this is the same as
+    get_game_status(), but needs no session.
+
+    Every spectator waiting on the same version is sent the same cached
+    response, so the status is encoded once per version however many
+    people are watching"""
+    check_game_exists(game_id)
+    return game_status_response(game_id, SPECTATOR, version)
+
+
+def game_status_response(game_id, username, version):
+    """Return the response to a status request by the user given (see
+    get_game_status())"""
+    wait = get_long_poll_wait()
+
+    if not wait:
+        cached = get_cached_game_status(game_id, username, version)
+        if cached is not None:
+            return cached.make_response(request)
+
+    check_game_ready(game_id)
+
+    if wait:
+        game_store.wait_for_change(
+            game_id, lambda latest: latest.game.version > version, wait
+        )
+
+    return load_game_status(game_id, username, version).make_response(request)
+
+
+def check_game_ready(game_id):
+    """Abort with a 403 if the specified game has not started yet"""
+    if not game_store.get(game_id).get_status()["ready"]:
         abort(403)
 
-    username = get_username(game_id)
-    status = m.game.get_status(username)
 
-    if status["timestamp"] > timestamp:
-        return json.dumps(status)
+def get_cached_game_status(game_id, username, version):
+    """Return the CachedResponse for a status request if it is cached for the
+    latest revision of the game, without loading the game, or None if not"""
+    return status_cache.get(game_id, game_store.get_revision(game_id),
+                            ("status", username, version))
 
-    else:
-        return "", 204
 
+def load_game_status(game_id, username, version):
+    """Return the CachedResponse for a request by the user for the status of
+    the game since the version given: either the status or a 204 if the game
+    has not changed"""
+    key = ("status", username, version)
 
-@app.route("/play/<int:game_id>/action/", methods=["POST"])
-def perform_action(game_id):
-    """Perform an action in the specified game"""
+    with game_store.lock(game_id):
+        m = game_store.get(game_id)
+        revision = game_store.get_revision(game_id)
+        cached = status_cache.get(game_id, revision, key)
+
+        if cached is None:
+            body = None
+            if m.game.version > version:
+                with metrics.timer("engine_seconds", stage="status_json"):
+                    body = m.game.get_status_json(username, since=version)
+            cached = status_cache.put(game_id, revision, key, body)
+
+    return cached
+
+
+@app.route("/play/<game_id:game_id>/route/")
+def get_routes(game_id):
+    """Return, as JSON, the user's current city and the number of dice points
+    needed to reach each of their remaining cities from there along with the
+    cheapest route to each"""
     check_game_exists(game_id)
-    m = get_matchmaker(game_id)
+    username = get_username(game_id)
 
-    if not m.get_status()["ready"]:
-        abort(403)
+    with game_store.lock(game_id):
+        m = game_store.get(game_id)
+
+        if not m.get_status()["ready"]:
+            abort(403)
 
+        player = m.game.get_player(username)
+        if player is None:
+            abort(403)
+
+        current_city = player.current_city
+        remaining = player.get_remaining_cities()
+
+    table = get_route_table(m.game.game_map)
+    cities = []
+    for city in remaining:
+        cities.append({
+            "id": city,
+            "distance": table.get_distance(current_city, city),
+            "route": table.get_route(current_city, city)
+        })
+
+    return json.dumps({"current_city": current_city, "cities": cities})
+
+
+@app.route("/play/<game_id:game_id>/action/", methods=["POST"])
+def perform_action(game_id):
+    """Perform an action in the specified game. If the 'version' form field
+    is given and the game has changed since that version, return a 409
+    without performing the action"""
+    check_game_exists(game_id)
     username = get_username(game_id)
 
     try:
@@ -191,8 +484,30 @@ def perform_action(game_id):
     except (KeyError, ValueError):
         return "Must provide integer value 'action_id'", 400
 
-    m.game.perform_action(action_id, username)
-    save_matchmaker(game_id, m)
+    version = request.form.get("version", type=int)
+    return perform_action_as(game_id, username, action_id, version)
+
+
+def perform_action_as(game_id, username, action_id, version=None):
+    """Perform an action in a game as the user given and save the game.
+    Return a (message, HTTP status code) tuple"""
+    with game_store.lock(game_id):
+        m = game_store.get(game_id)
+
+        if not m.get_status()["ready"]:
+            abort(403)
+
+        if version is not None and version != m.game.version:
+            return "The game has changed since version {}".format(version), 409
+
+        try:
+            m.game.perform_action(action_id, username)
+        except AuthenticationException as e:
+            return str(e), 403
+        except InvalidActionException as e:
+            return str(e), 400
+        game_store.save(game_id, m)
+
     return "Success", 200
 
 
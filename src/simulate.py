@@ -0,0 +1,203 @@
+"""Headless simulation of complete games to benchmark the game engine.
+
+Each game is played by a policy: a function which takes a Game object and a
+random.Random object and returns the ID of the action the current player
+should perform. Games and policies are seeded, so a run is reproducible for a
+given seed.
+
+Usage: python simulate.py --help
+"""
+import time
+import random
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import bots
+from gamemap import MAPS, get_map
+from jte import Game
+
+
+# Stop games that have not finished after this many actions
+MAX_ACTIONS = 100000
+
+# Names of the Game methods to time
+TIMED_METHODS = ["get_links", "get_available_actions", "update_status"]
+
+
+class TimedGame(Game):
+    """A Game that records the total time spent in, and number of calls to,
+    each of the methods in TIMED_METHODS"""
+
+    def __init__(self, *args, **kwargs):
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        super().__init__(*args, **kwargs)
+
+
+def add_timer(name):
+    method = getattr(Game, name)
+
+    def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        self.timings[name] += time.perf_counter() - start
+        self.calls[name] += 1
+        return result
+
+    timed.__name__ = name
+    timed.__doc__ = method.__doc__
+    setattr(TimedGame, name, timed)
+
+
+for name in TIMED_METHODS:
+    add_timer(name)
+
+
+def random_policy(game, rng):
+    """Choose an available action at random"""
+    return rng.choice(game.available_actions).id
+
+
+def greedy_policy(game, rng):
+    """Travel to one of the player's cities if possible, otherwise make a
+    random move"""
+    player = game.current_player
+    for action in game.available_actions:
+        if (action.type == Game.TRAVEL_ACTION and
+                player.can_collect(action.link.to_city)):
+            return action.id
+
+    return random_policy(game, rng)
+
+
+def bot_policy(game, rng):
+    """Choose the action a computer-controlled player would (see bots.py)"""
+    return bots.choose_action(game)
+
+
+POLICIES = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "bot": bot_policy
+}
+
+
+def play_game(map_id, no_of_players, policy, seed):
+    """Play a single game to completion and return the TimedGame object and
+    the number of actions performed"""
+    rng = random.Random(seed)
+    names = ["Player {}".format(i + 1) for i in range(no_of_players)]
+    game = TimedGame(get_map(map_id), names, seed=seed)
+
+    actions = 0
+    while game.in_progress and actions < MAX_ACTIONS:
+        action_id = policy(game, rng)
+        game.perform_action(action_id, game.current_player.name)
+        actions += 1
+
+    return game, actions
+
+
+def get_leader_progress(game):
+    """Return the fraction of their cities the player closest to winning the
+    game has visited"""
+    return max(len(p.cities_visited) / len(p.cities) for p in game.players)
+
+
+def run_batch(args):
+    """Play games with the given seeds and return a dictionary of totals. This
+    is run in worker processes so takes a single tuple of arguments"""
+    map_id, no_of_players, policy_name, seeds = args
+    totals = {
+        "games": 0,
+        "actions": 0,
+        "unfinished": 0,
+        "unfinished_progress": 0,
+        "timings": defaultdict(float),
+        "calls": defaultdict(int)
+    }
+
+    for seed in seeds:
+        game, actions = play_game(map_id, no_of_players, POLICIES[policy_name],
+                                  seed)
+        totals["games"] += 1
+        totals["actions"] += actions
+        if game.in_progress:
+            totals["unfinished"] += 1
+            totals["unfinished_progress"] += get_leader_progress(game)
+        for name in TIMED_METHODS:
+            totals["timings"][name] += game.timings[name]
+            totals["calls"][name] += game.calls[name]
+
+    return totals
+
+
+def simulate(map_id, no_of_players, policy_name, games, seed=0, processes=1):
+    """Play the given number of games, optionally spread across a pool of
+    processes, and return a dictionary of totals including the elapsed wall
+    clock time"""
+    seeds = [seed + i for i in range(games)]
+    batches = [(map_id, no_of_players, policy_name, seeds[i::processes])
+               for i in range(processes)]
+
+    start = time.perf_counter()
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(run_batch, batches)
+    else:
+        results = [run_batch(batches[0])]
+    elapsed = time.perf_counter() - start
+
+    totals = results[0]
+    for result in results[1:]:
+        for key in ["games", "actions", "unfinished", "unfinished_progress"]:
+            totals[key] += result[key]
+        for name in TIMED_METHODS:
+            totals["timings"][name] += result["timings"][name]
+            totals["calls"][name] += result["calls"][name]
+
+    totals["elapsed"] = elapsed
+    return totals
+
+
+def print_report(map_id, no_of_players, policy_name, totals):
+    elapsed = totals["elapsed"]
+    print("{} map, {} players, {} policy".format(map_id, no_of_players,
+                                                 policy_name))
+    print("  {} games ({} unfinished), {} actions in {:.2f}s".format(
+        totals["games"], totals["unfinished"], totals["actions"], elapsed))
+    print("  {:.1f} games/s, {:.0f} actions/s".format(
+        totals["games"] / elapsed, totals["actions"] / elapsed))
+    if totals["unfinished"]:
+        print("  leader of unfinished games had visited {:.0%} of cities".format(
+            totals["unfinished_progress"] / totals["unfinished"]))
+
+    for name in TIMED_METHODS:
+        t = totals["timings"][name]
+        calls = totals["calls"][name]
+        print("  {:<22} {:8.3f}s {:9d} calls {:7.2f} us/call".format(
+            name, t, calls, t * 1e6 / max(calls, 1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=200,
+                        help="number of games to play on each map")
+    parser.add_argument("--players", type=int, default=3,
+                        help="number of players in each game (reduced if a "
+                             "map is too small)")
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--map", dest="maps", action="append",
+                        choices=sorted(MAPS),
+                        help="map to play on (default: all maps)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of worker processes to use")
+    args = parser.parse_args()
+
+    for map_id in args.maps or sorted(MAPS):
+        no_of_players = min(args.players, get_map(map_id).max_players)
+        totals = simulate(map_id, no_of_players, args.policy, args.games,
+                          args.seed, args.processes)
+        print_report(map_id, no_of_players, args.policy, totals)
@@ -0,0 +1,138 @@
+"""Compact serialisation of Matchmaker and Game objects.
+
+A snapshot is a JSON array whose first element is the schema version. Maps
+are stored by ID only, and derived state (available actions and the status)
+is recalculated when a snapshot is loaded.
+
+Fields added since a schema version was introduced are appended to the end of
+the arrays and given default values when loading older snapshots.
+"""
+import json
+
+from gamemap import get_map
+from jte import Game, GameRandom, Player, Turn, CircularQueue, MessageLog
+from matchmaking import Matchmaker
+
+
+SCHEMA_VERSION = 1
+
+
+class InvalidSnapshotException(Exception):
+    """The snapshot could not be loaded"""
+
+
+def dump_matchmaker(matchmaker):
+    """Return a snapshot of the Matchmaker object provided as bytes"""
+    game = None
+    if matchmaker.game is not None:
+        game = dump_game(matchmaker.game)
+
+    snapshot = [
+        SCHEMA_VERSION,
+        matchmaker.game_map.map_id,
+        matchmaker.no_of_players,
+        matchmaker.player_names,
+        game,
+        matchmaker.bot_names
+    ]
+    return json.dumps(snapshot, separators=(",", ":")).encode()
+
+
+def load_matchmaker(data):
+    """Return a Matchmaker object from a snapshot created with
+    dump_matchmaker()"""
+    try:
+        snapshot = json.loads(data.decode())
+    except ValueError as e:
+        raise InvalidSnapshotException("Snapshot is not valid JSON: " + str(e))
+
+    if not snapshot or snapshot[0] != SCHEMA_VERSION:
+        raise InvalidSnapshotException("Unsupported snapshot schema version")
+
+    schema_version, map_id, no_of_players, player_names, game = snapshot[:5]
+    bot_names = snapshot[5] if len(snapshot) > 5 else []
+
+    matchmaker = Matchmaker(no_of_players, get_map(map_id))
+    matchmaker.player_names = player_names
+    matchmaker.bot_names = bot_names
+    if game is not None:
+        matchmaker.game = load_game(game, matchmaker.game_map)
+
+    return matchmaker
+
+
+def dump_game(game):
+    """Return a JSON-serialisable list containing the state of the Game object
+    provided"""
+    turn = game.current_turn
+    return [
+        game.in_progress,
+        game.winner,
+        game.version,
+        [[p.name, p.cities, p.home_city, p.cities_visited, p.current_city,
+          p.waiting_at_port] for p in game.players],
+        game.players.index(game.current_player),
+        game.player_queue.current_index,
+        [turn.dice_roll, turn.dice_points, turn.flown, turn.cities],
+        [[m["id"], m["message"]] for m in game.message_log.get_list()],
+        game.message_log.next_id,
+        game.bot_names,
+        game.seed,
+        game.rng.count,
+        [x for action in game.action_log for x in action]
+    ]
+
+
+def load_game(state, game_map):
+    """Return a Game object from the list returned by dump_game()"""
+    (in_progress, winner, version, players, current_player_index,
+     queue_index, turn, messages, next_message_id) = state[:9]
+    bot_names = state[9] if len(state) > 9 else []
+    if len(state) > 10:
+        seed, rng_count, action_log = state[10:13]
+    else:
+        seed, rng_count, action_log = 0, 0, []
+
+    game = Game.__new__(Game)
+    game.seed = seed
+    game.rng = GameRandom(seed, rng_count)
+    game.bot_names = bot_names
+    game.action_log = list(zip(action_log[::2], action_log[1::2]))
+    game.game_map = game_map
+    game.sea_ports = game_map.sea_ports
+    game.in_progress = in_progress
+    game.winner = winner
+
+    game.players = []
+    for (name, cities, home_city, cities_visited, current_city,
+         waiting_at_port) in players:
+        p = Player(name, cities, home_city)
+        p.set_visited(cities_visited)
+        p.current_city = current_city
+        p.waiting_at_port = waiting_at_port
+        game.players.append(p)
+
+    game.player_queue = CircularQueue(game.players)
+    game.player_queue.current_index = queue_index
+    game.current_player = game.players[current_player_index]
+
+    game.current_turn = Turn(None)
+    (game.current_turn.dice_roll, game.current_turn.dice_points,
+     game.current_turn.flown, game.current_turn.cities) = turn
+
+    game.message_log = MessageLog()
+    for i, (message_id, message) in enumerate(messages):
+        game.message_log.messages[i] = {"id": message_id, "message": message}
+    game.message_log.ptr = len(messages) % MessageLog.MAX_MESSAGES
+    game.message_log.next_id = next_message_id
+
+    # Recalculate available actions and the status. update_status()
+    # increments the version so start from the one before
+    game.status = None
+    game.status_versions = {}
+    game.status_json_cache = {}
+    game.version = version - 1
+    game.available_actions = game.get_available_actions()
+    game.update_status()
+
+    return game
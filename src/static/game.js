@@ -1,7 +1,4 @@
-function Map(cities_str, airports_str) {
-
-    var cities = JSON.parse(cities_str);
-    var airports = JSON.parse(airports_str);
+function Map(cities, airports) {
 
     /*
      * Throw an exception if the provided ID is invalid;
@@ -439,6 +436,12 @@ function Game(game_map, canvas) {
             this.hideCityLocation(city_id);
         }
 
+        // Spectators have no cards
+        if (!("my_cards" in status)) {
+            $("#card-list").append($("<li>").text("Watching"));
+            return;
+        }
+
         for (let i=0; i<status.my_cards.length; i++) {
             var $li = $("<li>").append(map.getCityName(status.my_cards[i].id));
 
@@ -626,11 +629,10 @@ function Game(game_map, canvas) {
 
             var $msgs = $("#right-panel .game-message");
 
-            if ($msgs.length == 0 ||
-                msg["timestamp"] > $msgs.last().data("timestamp")) {
+            if ($msgs.length == 0 || msg["id"] > $msgs.last().data("id")) {
 
                 var $msg_p = $("<p>", {"class": "message game-message"});
-                $msg_p.data("timestamp", msg["timestamp"]);
+                $msg_p.data("id", msg["id"]);
                 $msg_p.text(msg["message"]);
 
                 $("#right-panel").append($msg_p);
@@ -854,9 +856,16 @@ function performAction(action_id) {
     $.ajax(ACTION_URL, {
         "method": "POST",
         "data": {
-            "action_id": action_id
+            "action_id": action_id,
+            "version": latest_version
         },
         "error": function(request, status, error) {
+            // The game has changed since the displayed status, so get the
+            // latest status and let the user choose again
+            if (request.status == 409) {
+                getStatus();
+                return;
+            }
             throw "Unexpected error performing action";
         },
         "success": function(response, status, request) {
@@ -866,13 +875,29 @@ function performAction(action_id) {
 }
 
 /*
- * Send an AJAX request to be updated on the current status of the game
+ * Send an AJAX request to be updated on the current status of the game, and
+ * schedule the next request once it completes. When long polling the server
+ * holds the request open until there is a new status, so the next request is
+ * sent straight away; otherwise fall back to polling every UPDATE_INTERVAL ms
  */
 function getStatus() {
-    $.ajax(STATUS_URL + latest_timestamp + "/", {
+    window.clearTimeout(status_timer);
+
+    // A request is already in progress and will schedule the next one
+    if (status_request !== null) {
+        return;
+    }
+
+    var url = STATUS_URL + latest_version + "/";
+    if (long_poll) {
+        url += "?wait=" + LONG_POLL_WAIT;
+    }
+
+    status_request = $.ajax(url, {
         "method": "GET",
+        "timeout": (LONG_POLL_WAIT + 10) * 1000,
         "error": function(request, status, error) {
-            throw "Unexpected error retrieving status";
+            long_poll = false;
         },
         "success": function(response, status, request) {
             // $("#debug-area").text(response);
@@ -881,10 +906,28 @@ function getStatus() {
             // has happened)
             if (request.status == 200) {
                 var game_status = JSON.parse(response);
-                latest_timestamp = game_status.timestamp;
+                latest_version = game_status.version;
+
+                // Apply changes since the last version to the current status.
+                // Messages in the delta are only the new ones, which is all
+                // updateDisplay() needs
+                if (game_status.delta && current_status !== null) {
+                    delete current_status.actions;
+                    for (var key in game_status) {
+                        current_status[key] = game_status[key];
+                    }
+                }
+                else {
+                    current_status = game_status;
+                }
 
-                game.updateDisplay(game_status);
+                game.updateDisplay(current_status);
             }
+        },
+        "complete": function() {
+            status_request = null;
+            status_timer = window.setTimeout(getStatus,
+                                             long_poll ? 0 : UPDATE_INTERVAL);
         }
     });
 }
@@ -935,8 +978,12 @@ function setCanvasSize(canvas) {
     });
 }
 
+// Interval in ms between status requests if long polling is not available
 const UPDATE_INTERVAL = 1000;
 
+// Number of seconds the server may hold a status request open for
+const LONG_POLL_WAIT = 25;
+
 const ROLL_DICE_ACTION = "roll_dice";
 const TRAVEL_ACTION = "travel";
 const WAIT_AT_PORT_ACTION = "wait_at_port";
@@ -996,18 +1043,22 @@ var ART_SIZES = {
 
 var images = {};
 images.map = new Image();
-images.map.src = "/static/europe.png";
+images.map.src = MAP_IMAGE_URL;
 
 images.flight_plan = new Image();
 images.flight_plan.src = "/static/flight-plan.png";
 
-var cities_str = document.getElementById("cities").innerHTML;
-var airports_str = document.getElementById("airports").innerHTML;
-cities_str = cities_str.replace(/&#34;/g, '"');
-airports_str = airports_str.replace(/&#34;/g, '"');
-var map = new Map(cities_str, airports_str);
+// The map is fetched separately from the page so that browsers can cache it
+var map = null;
 
-var latest_timestamp = 1.1;
+var latest_version = 0;
+var current_status = null;
+
+// Whether to use long polling for status requests. This is turned off if a
+// request fails
+var long_poll = true;
+var status_request = null;
+var status_timer = null;
 
 var canvas = $("#game-canvas")[0];
 
@@ -1041,17 +1092,25 @@ function start_game() {
 
     // Get the status and start the update loop
     getStatus();
-    window.setInterval(getStatus, UPDATE_INTERVAL);
 }
 
-// Don't start game until all images are loaded
-var loaded_images = 0;
-for (let i in images) {
-    images[i].onload = function() {
-        loaded_images++;
+// Don't start game until all images and the map are loaded
+var loaded_resources = 0;
+var total_resources = Object.keys(images).length + 1;
 
-        if (loaded_images == Object.keys(images).length) {
-            start_game();
-        }
+function resourceLoaded() {
+    loaded_resources++;
+
+    if (loaded_resources == total_resources) {
+        start_game();
     }
 }
+
+for (let i in images) {
+    images[i].onload = resourceLoaded;
+}
+
+$.getJSON(MAP_URL, function(map_data) {
+    map = new Map(map_data.cities, map_data.airports);
+    resourceLoaded();
+});
@@ -0,0 +1,577 @@
+import os
+import re
+import time
+import fcntl
+import heapq
+import pickle
+import binascii
+import itertools
+import threading
+
+import snapshot
+from fileutil import write_atomic, TEMP_FILE_PREFIX
+from metrics import metrics
+
+
+# Number of random bytes in a game ID, and a regular expression that matches
+# game IDs
+GAME_ID_BYTES = 8
+GAME_ID_REGEX = "[0-9a-f]{{{}}}".format(2 * GAME_ID_BYTES)
+
+# Prefix for lock files used by directory backends. Temporary files start with
+# fileutil.TEMP_FILE_PREFIX
+LOCK_FILE_PREFIX = ".lock-"
+
+# Suffix of the action log files written by EventLogDirectoryBackend
+LOG_FILE_SUFFIX = ".log"
+
+
+class GameNotFoundException(Exception):
+    """There is no game with the specified ID"""
+
+
+def new_game_id():
+    """Return a random, hard to guess game ID as a string of hex digits"""
+    return binascii.hexlify(os.urandom(GAME_ID_BYTES)).decode()
+
+
+def is_game_id(game_id):
+    """Return True if the string provided has the form of a game ID returned
+    by new_game_id(). Other names in a games directory, such as lock files,
+    are never game IDs"""
+    return re.fullmatch(GAME_ID_REGEX, game_id) is not None
+
+
+class DirectoryBackend(object):
+    """A storage backend that saves each Matchmaker object to a file named
+    after the game ID in a directory. Subclasses define how Matchmaker objects
+    are encoded"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        if not os.path.isdir(self.directory):
+            os.mkdir(self.directory)
+
+    def get_filename(self, game_id):
+        return os.path.join(self.directory, str(game_id))
+
+    def exists(self, game_id):
+        return os.path.isfile(self.get_filename(game_id))
+
+    def list_ids(self):
+        return [f for f in os.listdir(self.directory)
+                if not f.startswith((TEMP_FILE_PREFIX, LOCK_FILE_PREFIX))]
+
+    def get_modified_time(self, game_id):
+        """Return the time the specified game was last saved"""
+        return os.path.getmtime(self.get_filename(game_id))
+
+    def get_stamp(self, game_id):
+        """Return a value that changes every time the specified game is saved,
+        or None if the game does not exist. Since files are replaced rather
+        than overwritten the inode number changes on every save"""
+        try:
+            stat = os.stat(self.get_filename(game_id))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def lock(self, game_id):
+        """Acquire an exclusive lock on the specified game that is shared
+        between processes, blocking until it is available. Return an object to
+        pass to unlock()"""
+        lock_file = open(os.path.join(self.directory,
+                                      LOCK_FILE_PREFIX + str(game_id)), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def unlock(self, lock_file):
+        """Release a lock returned by lock()"""
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def load(self, game_id):
+        """Load and return the Matchmaker object for the specifed game"""
+        with open(self.get_filename(game_id), "rb") as f:
+            return self.decode(f.read())
+
+    def save(self, game_id, matchmaker):
+        """Atomically write the Matchmaker object provided to a file"""
+        data = self.encode(matchmaker)
+        write_atomic(self.get_filename(game_id), data)
+        metrics.increment("store_bytes_written_total", len(data))
+
+    def delete(self, game_id):
+        for filename in [self.get_filename(game_id),
+                         os.path.join(self.directory,
+                                      LOCK_FILE_PREFIX + str(game_id))]:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def encode(self, matchmaker):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PickleDirectoryBackend(DirectoryBackend):
+    """A directory backend that pickles Matchmaker objects"""
+
+    def encode(self, matchmaker):
+        return pickle.dumps(matchmaker)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class SnapshotDirectoryBackend(DirectoryBackend):
+    """A directory backend that stores Matchmaker objects in the compact
+    snapshot format (see snapshot.py)"""
+
+    def encode(self, matchmaker):
+        return snapshot.dump_matchmaker(matchmaker)
+
+    def decode(self, data):
+        return snapshot.load_matchmaker(data)
+
+
+class EventLogDirectoryBackend(SnapshotDirectoryBackend):
+    """A directory backend that appends each action performed in a game to a
+    log file next to its snapshot, and only rewrites the snapshot every
+    SNAPSHOT_INTERVAL actions. Loading a game restores the snapshot and
+    replays the actions logged after it was taken.
+
+    The log covers the whole game, so together with the seed and players in
+    the snapshot it can be used to replay the game from the start (see
+    Game.replay())"""
+
+    SNAPSHOT_INTERVAL = 50
+
+    def __init__(self, directory):
+        super().__init__(directory)
+
+        # The number of actions in the log file and the latest snapshot of
+        # each game this backend has loaded or saved
+        self.logged = {}
+        self.snapshotted = {}
+
+    def get_log_filename(self, game_id):
+        return self.get_filename(game_id) + LOG_FILE_SUFFIX
+
+    def list_ids(self):
+        return [i for i in super().list_ids()
+                if not i.endswith(LOG_FILE_SUFFIX)]
+
+    def get_modified_time(self, game_id):
+        try:
+            log_time = os.path.getmtime(self.get_log_filename(game_id))
+        except FileNotFoundError:
+            log_time = 0
+        return max(super().get_modified_time(game_id), log_time)
+
+    def get_stamp(self, game_id):
+        stamp = super().get_stamp(game_id)
+        if stamp is None:
+            return None
+
+        try:
+            stat = os.stat(self.get_log_filename(game_id))
+        except FileNotFoundError:
+            return stamp
+        return stamp + (stat.st_size, stat.st_mtime_ns)
+
+    def read_log(self, game_id):
+        """Return the list of (player index, action ID) pairs in the log for
+        the specified game. An incomplete final line left by a crash while
+        appending is removed from the file, so that the next action is
+        appended on a line of its own"""
+        filename = self.get_log_filename(game_id)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            os.truncate(filename, complete)
+
+        lines = data[:complete].decode().split("\n")[:-1]
+        return [tuple(int(x) for x in line.split()) for line in lines]
+
+    def load(self, game_id):
+        matchmaker = super().load(game_id)
+        actions = self.read_log(game_id)
+        game = matchmaker.game
+
+        if game is not None:
+            self.snapshotted[game_id] = len(game.action_log)
+            for player_index, action_id in actions[len(game.action_log):]:
+                game.perform_action(action_id, game.players[player_index].name)
+
+        self.logged[game_id] = len(actions)
+        return matchmaker
+
+    def save(self, game_id, matchmaker):
+        game = matchmaker.game
+        if game is None:
+            super().save(game_id, matchmaker)
+            return
+
+        if game_id not in self.logged:
+            self.logged[game_id] = len(self.read_log(game_id))
+
+        new_actions = game.action_log[self.logged[game_id]:]
+        if new_actions:
+            data = "".join("{} {}\n".format(*a) for a in new_actions)
+            with open(self.get_log_filename(game_id), "a") as f:
+                f.write(data)
+                metrics.increment("store_bytes_written_total", len(data))
+                f.flush()
+                os.fsync(f.fileno())
+            self.logged[game_id] = len(game.action_log)
+
+        last_snapshot = self.snapshotted.get(game_id)
+        if (last_snapshot is None or len(game.action_log) - last_snapshot >=
+                EventLogDirectoryBackend.SNAPSHOT_INTERVAL):
+            super().save(game_id, matchmaker)
+            self.snapshotted[game_id] = len(game.action_log)
+
+    def delete(self, game_id):
+        super().delete(game_id)
+        try:
+            os.remove(self.get_log_filename(game_id))
+        except FileNotFoundError:
+            pass
+        self.logged.pop(game_id, None)
+        self.snapshotted.pop(game_id, None)
+
+
+class GameLock(object):
+    """A reentrant lock for a single game. If shared is True the lock is also
+    held across processes using the backend's lock() and unlock() methods
+    while any thread in this process holds it.
+
+    This implements the methods threading.Condition uses to fully release
+    and reacquire a reentrant lock while waiting, so it can be used as the
+    lock for a condition"""
+
+    def __init__(self, backend, game_id, shared):
+        self.backend = backend
+        self.game_id = game_id
+        self.shared = shared
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.backend_lock = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.rlock.acquire(blocking, timeout):
+            return False
+
+        self.depth += 1
+        if self.depth == 1 and self.shared:
+            self.backend_lock = self.backend.lock(self.game_id)
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.shared:
+            self.backend.unlock(self.backend_lock)
+            self.backend_lock = None
+        self.rlock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _is_owned(self):
+        return self.rlock._is_owned()
+
+    def _release_save(self):
+        depth = self.depth
+        self.depth = 0
+        if self.shared:
+            self.backend.unlock(self.backend_lock)
+            self.backend_lock = None
+        return (depth, self.rlock._release_save())
+
+    def _acquire_restore(self, saved):
+        depth, rlock_state = saved
+        self.rlock._acquire_restore(rlock_state)
+        if self.shared:
+            self.backend_lock = self.backend.lock(self.game_id)
+        self.depth = depth
+
+
+class GameStore(object):
+    """An in-process cache of live Matchmaker objects in front of a storage
+    backend. Games are loaded from the backend the first time they are
+    requested and written back every time they are saved, so reading a game
+    that is already cached never touches the backend.
+
+    The store also keeps an index of the IDs of all games in the backend so
+    that checking whether a game exists and allocating new IDs does not
+    require listing the backend, and the time each game was last saved so
+    that idle games can be evicted (see evict_idle() and start_reaper()).
+
+    Callers that modify a game should hold the lock for that game (see
+    lock()) from loading it until it has been saved. Saving a game wakes up
+    any threads waiting for it to change (see wait_for_change()).
+
+    If shared is True the backend may also be used by other processes (e.g.
+    multiple server workers). Game locks are then also held across processes,
+    cached games are checked against the backend before being returned,
+    and games created by other processes are found by asking the backend"""
+
+    # Number of seconds between checks for changes made by other processes
+    # when waiting for a game to change
+    SHARED_POLL_INTERVAL = 0.5
+
+    def __init__(self, backend, shared=False):
+        self.backend = backend
+        self.shared = shared
+        self.games = {}
+        self.stamps = {}  # Backend stamp of each cached game when loaded
+        self.locks = {}
+
+        # Revision of each game saved by this store (see get_revision())
+        self.revisions = {}
+        self.revision_counter = itertools.count(1)
+
+        # Functions to call with the game ID and whether it was evicted when a
+        # game is saved or evicted
+        self.listeners = []
+        self.game_ids = set(self.backend.list_ids())
+
+        # Protects the dictionaries, sets and heap in this object
+        self.store_lock = threading.Lock()
+
+        # Time each game was last saved, and a heap of (time, game ID) pairs
+        # ordered by time. The heap may contain old entries for games that
+        # have been saved again since, which are skipped when evicting
+        self.last_activity = {}
+        self.activity_heap = []
+        for game_id in self.game_ids:
+            self.touch(game_id, self.backend.get_modified_time(game_id))
+
+        self.evictions = 0
+
+    def lock(self, game_id):
+        """Return the lock for the specified game. This is a
+        threading.Condition around a GameLock which is notified whenever the
+        game is saved"""
+        game_id = str(game_id)
+        with self.store_lock:
+            if game_id not in self.locks:
+                lock = GameLock(self.backend, game_id, self.shared)
+                self.locks[game_id] = threading.Condition(lock)
+            return self.locks[game_id]
+
+    def exists(self, game_id):
+        """Return True if a game with the specified ID exists"""
+        game_id = str(game_id)
+        if not is_game_id(game_id):
+            return False
+        if game_id in self.game_ids:
+            return True
+
+        # The game may have been created by another process
+        if self.shared and self.backend.exists(game_id):
+            with self.store_lock:
+                self.game_ids.add(game_id)
+            self.touch(game_id, self.backend.get_modified_time(game_id))
+            return True
+
+        return False
+
+    def count(self):
+        """Return the number of games in the store"""
+        return len(self.game_ids)
+
+    def create(self, matchmaker):
+        """Save the Matchmaker object provided as a new game and return the
+        newly allocated game ID"""
+        with self.store_lock:
+            game_id = new_game_id()
+            while game_id in self.game_ids:
+                game_id = new_game_id()
+
+            self.game_ids.add(game_id)
+
+        self.save(game_id, matchmaker)
+        return game_id
+
+    def get(self, game_id):
+        """Return the Matchmaker object for the specified game"""
+        game_id = str(game_id)
+        with self.lock(game_id):
+            if game_id not in self.game_ids:
+                raise GameNotFoundException("No game with ID " + game_id)
+
+            if self.shared:
+                # Reload the game if another process has saved or deleted it
+                stamp = self.backend.get_stamp(game_id)
+                if stamp is None:
+                    self.forget(game_id)
+                    raise GameNotFoundException("No game with ID " + game_id)
+
+                if self.stamps.get(game_id) != stamp:
+                    self.games.pop(game_id, None)
+                    self.stamps[game_id] = stamp
+
+            if game_id not in self.games:
+                with metrics.timer("store_seconds", operation="load"):
+                    self.games[game_id] = self.backend.load(game_id)
+            return self.games[game_id]
+
+    def save(self, game_id, matchmaker):
+        """Store the Matchmaker object for the specified game in the cache and
+        write it to the backend"""
+        game_id = str(game_id)
+        condition = self.lock(game_id)
+        with condition:
+            # The game may have been evicted since it was loaded
+            if game_id not in self.game_ids:
+                raise GameNotFoundException("No game with ID " + game_id)
+
+            self.games[game_id] = matchmaker
+            with metrics.timer("store_seconds", operation="save"):
+                self.backend.save(game_id, matchmaker)
+            if self.shared:
+                self.stamps[game_id] = self.backend.get_stamp(game_id)
+            else:
+                self.revisions[game_id] = next(self.revision_counter)
+            self.touch(game_id, time.time())
+            condition.notify_all()
+        self.notify_listeners(game_id, evicted=False)
+
+    def add_listener(self, listener):
+        """Register a function to be called whenever a game is saved or
+        evicted by this store, with the game ID and True if the game was
+        evicted. Listeners are called from the thread that saved or evicted
+        the game and must not block"""
+        self.listeners.append(listener)
+
+    def notify_listeners(self, game_id, evicted):
+        for listener in self.listeners:
+            listener(game_id, evicted)
+
+    def get_revision(self, game_id):
+        """Return a value that changes whenever the specified game is saved,
+        without loading the game. In shared mode this is the backend stamp, so
+        saves by other processes are seen too"""
+        game_id = str(game_id)
+        if self.shared:
+            return self.backend.get_stamp(game_id)
+        return self.revisions.get(game_id)
+
+    def touch(self, game_id, timestamp):
+        """Record the time of the last activity in the specified game"""
+        with self.store_lock:
+            self.last_activity[game_id] = timestamp
+            heapq.heappush(self.activity_heap, (timestamp, game_id))
+
+    def wait_for_change(self, game_id, predicate, timeout):
+        """Block until predicate(matchmaker) is true for the specified game, the
+        game is evicted, or until timeout seconds have passed. Return the last
+        value of predicate"""
+        game_id = str(game_id)
+        condition = self.lock(game_id)
+
+        def done():
+            try:
+                return predicate(self.get(game_id))
+            except GameNotFoundException:
+                return True
+
+        with condition:
+            if not self.shared:
+                return condition.wait_for(done, timeout)
+
+            # Changes made by other processes do not notify the condition, so
+            # wake up regularly to check for them
+            end_time = time.time() + timeout
+            result = done()
+            while not result:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                condition.wait(min(remaining, GameStore.SHARED_POLL_INTERVAL))
+                result = done()
+            return result
+
+    def evict_idle(self, ttl):
+        """Remove games that have not been saved for ttl seconds from the
+        cache and the backend. Return the number of games evicted"""
+        cutoff = time.time() - ttl
+        evicted = 0
+
+        while True:
+            with self.store_lock:
+                if not self.activity_heap or self.activity_heap[0][0] > cutoff:
+                    break
+                timestamp, game_id = heapq.heappop(self.activity_heap)
+
+            # Skip old heap entries for games that have been saved since
+            if self.last_activity.get(game_id) != timestamp:
+                continue
+
+            condition = self.lock(game_id)
+            with condition:
+                # Check the game has not been saved while waiting for the lock
+                if self.last_activity.get(game_id) != timestamp:
+                    continue
+
+                # Check the game has not been saved by another process
+                if self.shared and self.backend.exists(game_id):
+                    modified_time = self.backend.get_modified_time(game_id)
+                    if modified_time > cutoff:
+                        self.touch(game_id, modified_time)
+                        continue
+
+                self.forget(game_id)
+                self.backend.delete(game_id)
+                condition.notify_all()
+
+            self.notify_listeners(game_id, evicted=True)
+            evicted += 1
+
+        self.evictions += evicted
+        return evicted
+
+    def forget(self, game_id):
+        """Remove the specified game from the index and cache"""
+        with self.store_lock:
+            self.game_ids.discard(game_id)
+            self.games.pop(game_id, None)
+            self.stamps.pop(game_id, None)
+            self.revisions.pop(game_id, None)
+            self.last_activity.pop(game_id, None)
+            self.locks.pop(game_id, None)
+
+    def start_reaper(self, ttl, interval=60):
+        """Start a background thread that evicts games that have been idle for
+        ttl seconds, checking every interval seconds"""
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle(ttl)
+
+        thread = threading.Thread(target=reap, name="game-reaper")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_stats(self):
+        """Return a dictionary of counters describing the store"""
+        return {
+            "games": len(self.game_ids),
+            "cached_games": len(self.games),
+            "evictions": self.evictions
+        }
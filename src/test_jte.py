@@ -0,0 +1,42 @@
+"""Tests for the game engine.
+
+Usage: python -m unittest test_jte
+"""
+import unittest
+
+from gamemap import get_map
+from jte import Game
+
+
+class StatusDeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.game = Game(get_map("europe"), ["A", "B"], seed=1)
+
+    def test_delta_includes_messages_from_action(self):
+        version = self.game.version
+        name = self.game.current_player.name
+        self.game.perform_action(0, name)
+
+        full = self.game.get_status(name)
+        delta = self.game.get_status(name, since=version)
+        self.assertTrue(delta["delta"])
+        self.assertEqual(delta["message_log"], full["message_log"][-1:])
+        self.assertIn("rolled", delta["message_log"][0]["message"])
+
+    def test_deltas_rebuild_message_log(self):
+        name = self.game.current_player.name
+        messages = list(self.game.get_status(name)["message_log"])
+
+        for i in range(20):
+            version = self.game.version
+            name = self.game.current_player.name
+            self.game.perform_action(0, name)
+            messages += self.game.get_status(name, since=version)["message_log"]
+
+        full = self.game.get_status(name)["message_log"]
+        self.assertEqual(messages[-len(full):], full)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Tests for game storage.
+
+Usage: python -m unittest test_store
+"""
+import shutil
+import tempfile
+import unittest
+
+from gamemap import get_map
+from matchmaking import Matchmaker
+from store import EventLogDirectoryBackend, GameStore
+
+
+class EventLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.matchmaker = Matchmaker(2, get_map("europe"))
+        for name in ["A", "B"]:
+            self.matchmaker.add_player(name)
+
+    def play(self, game, moves):
+        for i in range(moves):
+            game.perform_action(0, game.current_player.name)
+
+    def test_save_after_crash_mid_append(self):
+        backend = EventLogDirectoryBackend(self.directory)
+        backend.save("g", self.matchmaker)
+        self.play(self.matchmaker.game, 3)
+        backend.save("g", self.matchmaker)
+
+        # A crash while appending leaves part of a line at the end of the log
+        with open(backend.get_log_filename("g"), "a") as f:
+            f.write("1")
+
+        backend = EventLogDirectoryBackend(self.directory)
+        matchmaker = backend.load("g")
+        game = matchmaker.game
+        self.assertEqual(game.action_log, self.matchmaker.game.action_log)
+
+        self.play(game, 1)
+        backend.save("g", matchmaker)
+
+        loaded = EventLogDirectoryBackend(self.directory).load("g").game
+        self.assertEqual(loaded.action_log, game.action_log)
+        self.assertEqual(loaded.version, game.version)
+
+
+class SharedGameStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        backend = EventLogDirectoryBackend(self.directory)
+        self.store = GameStore(backend, shared=True)
+
+        matchmaker = Matchmaker(1, get_map("europe"))
+        matchmaker.add_player("A")
+        self.game_id = self.store.create(matchmaker)
+        with self.store.lock(self.game_id):
+            self.store.save(self.game_id, matchmaker)
+
+    def test_other_files_are_not_games(self):
+        self.assertTrue(self.store.exists(self.game_id))
+        for name in [self.game_id + ".log", ".lock-" + self.game_id,
+                     ".tmp-abc", "../" + self.game_id]:
+            self.assertFalse(self.store.exists(name), name)
+        self.assertEqual(self.store.count(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()